@@ -0,0 +1,109 @@
+# Adaptive batch sizing for Security + Coupon API calls (one batcher per api).
+# Batch size starts at 'batch_size' and grows while latency per bond keeps falling, then settles on the best size.
+# It shrinks on timeouts, 413/414 (request too large) and slow responses, and a batch never exceeds
+# 'max_query_length' characters of the url encoded comma separated bondId parameter.
+
+from collections import Counter
+from threading import Lock
+from urllib.parse import quote
+
+
+class AdaptiveBatcher:
+
+    samples_per_step = 3        # batches observed at a size before deciding to grow further
+    growth_factor = 1.5
+    improvement = 0.95          # latency per bond must drop at least 5% to keep growing
+
+    def __init__(self, name, log, batch_size=50, min_batch_size=5, max_batch_size=200, max_query_length=2000, slow_response=15):
+        self.name=name
+        self.log=log
+        self.min_size=max(1, int(min_batch_size))
+        self.max_size=max(self.min_size, int(max_batch_size))
+        self.size=min(max(int(batch_size), self.min_size), self.max_size)
+        self.max_query_length=int(max_query_length)
+        self.slow_response=float(slow_response)
+        self.lock=Lock()
+
+        self.settled=False              # stop growing once latency per bond stops improving
+        self.best_size=None
+        self.best_per_bond=None         # seconds per bond at best_size
+        self.samples=[]                 # seconds per bond observed at current size
+        self.sizes_used=Counter()       # batch size -> number of requests (for the log)
+
+
+
+    # Split securities into batches of the current size, capped by the max query string length
+    def split(self, securityList):
+        with self.lock:
+            size = self.size
+        batches = []
+        batch = []
+        query_length = 0
+        for security in securityList:
+            length = len(quote(str(security), safe='')) + (3 if batch else 0)     # ',' is sent url encoded as %2C
+            if batch and (len(batch) >= size or query_length + length > self.max_query_length):
+                batches.append(batch)
+                batch = []
+                query_length = 0
+                length = len(quote(str(security), safe=''))
+            batch.append(security)
+            query_length += length
+        if batch:
+            batches.append(batch)
+        return batches
+
+
+
+    # Successful response of a batch with 'count' bonds in 'elapsed' seconds
+    def record(self, count, elapsed):
+        with self.lock:
+            self.sizes_used[count] += 1
+            if elapsed >= self.slow_response:
+                self._resize(int(self.size * 0.75), f'slow response {elapsed:.1f}s')
+                return
+
+            # Small tail batches do not tell anything about the current size
+            if count < self.size * 0.8 or self.settled:
+                return
+            self.samples.append(elapsed / count)
+            if len(self.samples) < self.samples_per_step:
+                return
+
+            per_bond = sorted(self.samples)[len(self.samples) // 2]    # median, robust to one odd batch
+            if self.best_per_bond is None or per_bond < self.best_per_bond * self.improvement:
+                self.best_size, self.best_per_bond = self.size, per_bond
+                if self.size < self.max_size:
+                    self._resize(int(self.size * self.growth_factor) + 1, f'latency per bond improving {per_bond * 1000:.1f}ms')
+                else:
+                    self.settled = True
+            else:
+                # Gain too small to keep growing, settle on whichever of the last two sizes was faster
+                self.settled = True
+                if per_bond >= self.best_per_bond:
+                    self._resize(self.best_size, f'latency per bond not improving {per_bond * 1000:.1f}ms')
+            self.samples = []
+
+
+
+    # Failed batch: 'reason' is 'timeout' or HTTP status 413/414
+    def record_failure(self, count, reason):
+        with self.lock:
+            self._resize(min(self.size, count) // 2, reason)
+            self.settled = False
+            self.best_size = self.best_per_bond = None
+
+
+
+    def _resize(self, size, reason):
+        size = min(max(size, self.min_size), self.max_size)
+        if size != self.size:
+            self.log.info(f"{self.name} api batch size {self.size} -> {size} ({reason})")
+            self.size = size
+            self.samples = []
+
+
+
+    def summary(self):
+        with self.lock:
+            sizes = ', '.join(f'{size}x{count}' for size, count in sorted(self.sizes_used.items()))
+            return f"{self.name} api batch size now {self.size}, used [{sizes}]"
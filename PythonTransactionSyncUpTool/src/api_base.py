@@ -0,0 +1,203 @@
+# Common request/response plumbing shared by SecurityAPI and CouponAPI.
+# Sub classes only define 'name' and how to map the API json response (parse method on the decoded tree,
+# parse_stream on the raw bytes for json_parser=stream).
+# Requests are built once here, so they can be sent either with blocking requests (thread pool)
+# or with the asyncio engine (async_engine.py) without duplicating any logic.
+
+import requests
+from time import perf_counter
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from concurrent.futures import CancelledError
+from adaptive_batcher import AdaptiveBatcher
+from resilience import parse_retry_after
+from response_cache import ResponseCache
+from metrics import metrics
+from profiling import profiler
+from json_parser import select_backend, loads
+from bond_ids import SingleFlight
+from concurrency import ConcurrencyController
+
+
+
+# Raised when an api request fails, keeps what callers need to react on (shrink/split/retry)
+class APIRequestError(Exception):
+    def __init__(self, message, status=None, timeout=False, retry_after=None, mapping=False):
+        super().__init__(message)
+        self.status=status
+        self.timeout=timeout
+        self.retry_after=retry_after    # seconds from Retry-After header
+        self.mapping=mapping            # response could not be mapped (bad data for some bond)
+
+    # Request was too large for the endpoint, the batch has to be split
+    @property
+    def too_large(self):
+        return self.status in (413, 414)
+
+
+
+class APIBase:
+
+    name = 'api'
+
+    def __init__(self, url, token, user, pwd, log, max_concurrency=5, rate_limit=0, pool_size=None, compression=True,
+                 timeout=60, batch_size=50, min_batch_size=5, max_batch_size=200, max_query_length=2000, slow_response=15,
+                 cache_ttl=0, cache_max_entries=100000, cache_dir=None, json_parser='auto', min_concurrency=1, initial_concurrency=None,
+                 latency_spike=3, adaptive_concurrency=True):
+        self.log=log
+        self.url=url
+        self.token=token
+        self.user=user
+        self.pwd=pwd
+        self.request_id=12345678910
+        self.max_concurrency=int(max_concurrency)   # max parallel requests on this endpoint (ceiling of the adaptive limit)
+        self.rate_limit=float(rate_limit)           # max requests per second on this endpoint, 0 = no limit
+        self.pool_size=int(pool_size or max_concurrency)    # keep-alive connections kept open, one per request in flight by default
+        self.compression=str(compression).lower() in ('true', '1', 'yes')     # negotiate gzip/deflate response bodies
+        self.timeout=float(timeout)                 # seconds per request
+        self.json_parser=select_backend(json_parser, log)      # json / orjson / stream, see json_parser.py
+        self.batcher=AdaptiveBatcher(self.name, log, batch_size, min_batch_size, max_batch_size, max_query_length, slow_response)
+        self.cache=ResponseCache(self.name, log, cache_ttl, cache_max_entries, cache_dir or None, self.load_records)
+        self.flights=SingleFlight()                 # bonds in flight on this api, shared by concurrent requesters
+        # Parallel requests adapt to latency + throttling (AIMD), starts at the connection pool size unless configured
+        self.concurrency=ConcurrencyController(self.name, log, self.max_concurrency, min_concurrency,
+                                               initial_concurrency or min(self.pool_size, self.max_concurrency), latency_spike, adaptive_concurrency)
+        self.session=self.create_session()
+        self.log.debug(f'initialized {self.name} api {user}@{url} pool_size={self.pool_size} compression={self.compression} json_parser={self.json_parser}')
+
+
+
+    # One persistent session per api: keep-alive connection pool + basic auth created once,
+    # so batches reuse open TCP/TLS connections instead of a new handshake per request.
+    def create_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.auth = HTTPBasicAuth(self.user, self.pwd)
+        return session
+
+
+    def accept_encoding(self):
+        return 'gzip, deflate' if self.compression else 'identity'
+
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+
+
+
+    # Builds comma separated bondId list + headers + query params for one batch of securities
+    def build_request(self, securityList, assetClass='BOND'):
+        securityIDList = ",".join(security for security in securityList if isinstance(security, str))
+
+        headers = {
+            'Content-Type':'application/json',
+            'Request-ID':str(self.request_id),
+            'Origin-Timestamp':datetime.now().isoformat(timespec='milliseconds') + 'Z',
+            'API-Key':self.token,
+            'Accept-Encoding':self.accept_encoding()
+        }
+
+        params = {
+            'bondId':securityIDList,
+            'bondIdType':assetClass
+        }
+        return securityIDList, headers, params
+
+
+
+    # Maps the raw response body into list of records. Sub classes implement 'parse' and 'parse_stream'.
+    def parse_content(self, content, securityIDList):
+        try:
+            with profiler.stage(f'{self.name}_parse'):
+                if self.json_parser == 'stream':
+                    return self.parse_stream(content, securityIDList)
+                data = loads(self.json_parser, content)
+                return self.parse(data, securityIDList)
+        except Exception as e:
+            self.log.error(f"Mapping error for {securityIDList}: {str(e)} {repr(e)}")
+            raise APIRequestError(f"{self.name} api mapping error: {str(e)}", mapping=True) from e
+
+
+    def parse(self, data, securityIDList):
+        raise NotImplementedError
+
+
+    def parse_stream(self, content, securityIDList):
+        raise NotImplementedError
+
+
+    # Records read back from the persistent cache (json) -> the form parse returns, as is by default
+    def load_records(self, records):
+        return records
+
+
+
+    # Completed request: latency feeds the batcher, the concurrency limit and the run metrics
+    def record_request(self, securityList, elapsed, content):
+        self.batcher.record(len(securityList), elapsed)
+        self.concurrency.record(elapsed)
+        metrics.observe(f'{self.name}_api', elapsed)
+        metrics.count(f'{self.name}_api_requests')
+        metrics.count(f'{self.name}_api_bonds', len(securityList))
+        metrics.count(f'{self.name}_api_bytes', len(content or b''))
+
+
+    # Logs a failed request, lets the batcher shrink on timeouts / too large requests, backs off concurrency
+    # on timeouts / throttling and returns the error to raise
+    def request_error(self, securityList, securityIDList, error, status=None, timeout=False, retry_after=None):
+        self.log.warning(f"Request error on {self.url} for {securityIDList}: {str(error)} {repr(error)}")
+        metrics.count(f'{self.name}_api_errors')
+        if timeout:
+            self.batcher.record_failure(len(securityList), 'timeout')
+            self.concurrency.record_failure('timeout')
+        elif status in (413, 414):
+            self.batcher.record_failure(len(securityList), f'HTTP {status}')
+        elif status in (429, 503, 504):
+            self.concurrency.record_failure(f'HTTP {status}')
+        return APIRequestError(f"{self.name} api request failed: {str(error)}", status=status, timeout=timeout, retry_after=parse_retry_after(retry_after))
+
+
+
+    # Fetch details for a list of securities (one blocking request on the pooled session),
+    # waits while the endpoint already has its current concurrency limit of requests in flight
+    # 'cancelled' = optional Event, set while waiting for a slot the request is not sent (run already failed)
+    def fetch_all(self, securityList:list, assetClass='BOND', cancelled=None):
+        securityIDList, headers, params = self.build_request(securityList, assetClass)
+        headers.update(self.cache.conditional_headers(securityList, securityIDList))
+        with self.concurrency:
+            if cancelled is not None and cancelled.is_set():
+                raise CancelledError(f"{self.name} api request of {len(securityList)} bonds not sent, run cancelled")
+            start = perf_counter()      # latency is measured without the time spent waiting for a slot
+            try:
+                response = self.session.get(
+                    self.url,
+                    headers=headers,
+                    params=params,
+                    timeout=self.timeout
+                )
+                response.raise_for_status()
+
+            except requests.exceptions.Timeout as e:
+                raise self.request_error(securityList, securityIDList, e, timeout=True) from e
+            except requests.exceptions.HTTPError as e:
+                raise self.request_error(securityList, securityIDList, e, status=e.response.status_code, retry_after=e.response.headers.get('Retry-After')) from e
+            except requests.exceptions.RequestException as e:
+                raise self.request_error(securityList, securityIDList, e) from e
+
+        self.record_request(securityList, perf_counter() - start, response.content)
+        return self.handle_response(response.status_code, response.headers, response.content, securityList, securityIDList)
+
+
+
+    # 304 -> cached records are still valid, otherwise map the body and cache it with its validators
+    def handle_response(self, status, response_headers, content, securityList, securityIDList):
+        if status == 304:
+            return self.cache.revalidate(securityList)
+        records = self.parse_content(content, securityIDList)
+        if isinstance(records, list):
+            self.cache.put(securityList, securityIDList, records, response_headers.get('ETag'), response_headers.get('Last-Modified'))
+        return records
@@ -0,0 +1,111 @@
+# asyncio based client engine for Security + Coupon APIs.
+# All batches run as coroutines over one event loop (no thread per request), and every endpoint
+# gets its own concurrency + rate limit: the adaptive limit of the api (concurrency.py, ceiling max_concurrency)
+# and rate_limit from config.ini ([SECURITY_API]/[COUPON_API]).
+# aiohttp is only required when engine=async is configured in [FETCH].
+
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:     # engine=thread keeps working without aiohttp
+    aiohttp = None
+
+
+
+class EndpointLimiter:
+    # Limits parallel requests (current limit of the concurrency controller) and request rate (evenly spaced slots)
+    # of one endpoint. Must be created inside the running event loop.
+    def __init__(self, concurrency, rate_limit):
+        self.concurrency = concurrency
+        self.condition = asyncio.Condition()
+        self.interval = 1.0 / rate_limit if rate_limit and rate_limit > 0 else 0.0
+        self.next_slot = 0.0
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.concurrency.in_flight < self.concurrency.current)
+            self.concurrency.started()
+        if self.interval:
+            # Reserve next free slot, no await in between so this is safe within the loop
+            now = asyncio.get_running_loop().time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self.condition:
+            self.concurrency.finished()
+            self.condition.notify_all()
+
+
+
+class AsyncAPIEngine:
+
+    def __init__(self, apis, log):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required for engine=async, install it or set engine=thread in [FETCH]")
+        self.log=log
+        self.apis=apis
+        self.sessions={}
+        self.limiters={}
+
+
+
+    # Sync wrapper: runs the given coroutine function with one pooled keep-alive session + limiter per endpoint
+    def run(self, main, *args):
+        return asyncio.run(self._run(main, *args))
+
+
+    async def _run(self, main, *args):
+        self.limiters = {api.name: EndpointLimiter(api.concurrency, api.rate_limit) for api in self.apis}
+        self.sessions = {api.name: self.create_session(api) for api in self.apis}
+        try:
+            return await main(*args)
+        finally:
+            for session in self.sessions.values():
+                await session.close()
+            self.sessions = {}
+
+
+    # Connection pool sized to the endpoint concurrency, basic auth created once, gzip/deflate decoded by aiohttp
+    def create_session(self, api):
+        connector = aiohttp.TCPConnector(limit=max(api.max_concurrency, api.pool_size))
+        return aiohttp.ClientSession(
+            connector=connector,
+            auth=aiohttp.BasicAuth(api.user, api.pwd),
+            auto_decompress=api.compression
+        )
+
+
+
+    # Fetch one batch of securities from the given api (respecting its concurrency + rate limit)
+    async def fetch(self, api, securityList, assetClass='BOND'):
+        securityIDList, headers, params = api.build_request(securityList, assetClass)
+        headers.update(api.cache.conditional_headers(securityList, securityIDList))
+        loop = asyncio.get_running_loop()
+        async with self.limiters[api.name]:
+            start = loop.time()     # latency is measured without the time spent waiting on the limiter
+            try:
+                async with self.sessions[api.name].get(
+                    api.url,
+                    headers=headers,
+                    params=params,
+                    timeout=aiohttp.ClientTimeout(total=api.timeout)
+                ) as response:
+                    response.raise_for_status()
+                    content = await response.read()
+                    status, response_headers = response.status, response.headers
+
+            except asyncio.TimeoutError as e:
+                raise api.request_error(securityList, securityIDList, e, timeout=True) from e
+            except aiohttp.ClientResponseError as e:
+                raise api.request_error(securityList, securityIDList, e, status=e.status, retry_after=(e.headers or {}).get('Retry-After')) from e
+            except aiohttp.ClientError as e:
+                raise api.request_error(securityList, securityIDList, e) from e
+
+            api.record_request(securityList, loop.time() - start, content)
+
+        return api.handle_response(status, response_headers, content, securityList, securityIDList)
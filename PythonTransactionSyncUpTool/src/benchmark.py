@@ -0,0 +1,312 @@
+# Offline benchmark of the fetch pipeline: no live APIs, no SQL Server.
+# A synthetic universe of bonds is served by two local mock HTTP servers (security + coupon api) whose responses follow
+# Templates/security_api_response.json and Templates/coupon_api_response.json (same records and fields, under the root
+# keys the api clients read), with configurable latency, jitter and error rates. The db layer is replaced by a local
+# stand-in that records write patterns. Reports end-to-end throughput and per stage timings (metrics.py) for
+# SecurityAPI, CouponAPI, merge and save_data, so changes of batching / concurrency can be compared before release.
+#
+# Ex- python benchmark.py --bonds 100000 --latency 0.05 --jitter 0.02 --error-rate 0.01 --engine async
+#     python benchmark.py --bonds 20000 --dates 5 --json-parser stream --output bench.json
+
+import argparse
+import json
+import random
+import logging
+import threading
+from time import perf_counter, sleep
+from zlib import crc32
+from datetime import date, timedelta
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from metrics import metrics
+
+
+
+# Deterministic synthetic data per bond, the same bond always gets the same records (any universe size, nothing stored)
+class Universe:
+
+    def __init__(self, size, history=30, as_of=None):
+        self.size=int(size)
+        self.history=int(history)      # coupon records (days) per bond
+        self.as_of=as_of or date.today()
+
+    def bonds(self):
+        return (f"BND{i:07d}" for i in range(self.size))
+
+    def security(self, bond):
+        rnd = random.Random(crc32(bond.encode()))
+        return {
+            'assetId': bond,
+            'CASH_REP': {
+                'accrualDt': (self.as_of - timedelta(days=rnd.randint(0, 365))).isoformat(),
+                'country': rnd.choice(('DEN', 'USA', 'GBR', 'IND')),
+                'couponFix': round(rnd.uniform(0.5, 9.5), 4),
+                'couponFloat': round(rnd.uniform(0.5, 9.5), 4),
+                'cpnType': rnd.choice(('F', 'T')),
+                'currency': rnd.choice(('INR', 'USD', 'EUR')),
+                'bond': bond
+            }
+        }
+
+    def coupon(self, bond):
+        rnd = random.Random(crc32(bond.encode()) ^ 0x5f3759df)
+        records = {}
+        for day in range(self.history):
+            effective = (self.as_of - timedelta(days=day)).isoformat()
+            records[effective] = {
+                '@type': 'https://www.example.com/Coupon/CouponRecords',
+                'cpn': round(rnd.uniform(0.5, 9.5), 4),
+                'cpnEffectiveDate': effective,
+                'secGroup': 'CASH',
+                'secType': 'LLB',
+                'cpnSource': 'ADM'
+            }
+        return {'assetId': bond, 'couponByEffectiveDate': records}
+
+
+
+# Mock api server: answers 'GET ?bondId=A,B,C' with generated records after latency +- jitter,
+# 'error_rate' of requests fail with 503 (Retry-After: 0), batches holding a 'bad' bond fail with 400,
+# requests above 'throttle_above' in flight at once get 429 (0 = never), as a rate limiting gateway would
+class MockAPIServer:
+
+    def __init__(self, name, universe, latency=0.0, jitter=0.0, error_rate=0.0, bad_bonds=(), throttle_above=0):
+        self.name=name
+        self.requests=0
+        self.errors=0
+        self.throttled=0
+        self.in_flight=0
+        self.peak_in_flight=0
+        lock = threading.Lock()
+        server = self
+        root, build = ('bondByAssetId', universe.security) if name == 'security' else ('couponDataByAssetId', universe.coupon)
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'      # keep-alive, the clients pool connections
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                ids = [bond for bond in parse_qs(urlparse(self.path).query).get('bondId', [''])[0].split(',') if bond]
+                with lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.peak_in_flight = max(server.peak_in_flight, server.in_flight)
+                    throttled = throttle_above and server.in_flight > throttle_above
+                    if throttled:
+                        server.throttled += 1
+                try:
+                    if throttled:
+                        self.reply(429)
+                    else:
+                        self.answer(ids)
+                finally:
+                    with lock:
+                        server.in_flight -= 1
+
+            def reply(self, status):
+                self.send_response(status)
+                self.send_header('Retry-After', '0')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def answer(self, ids):
+                sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+                if random.random() < error_rate or any(bond in bad_bonds for bond in ids):
+                    with lock:
+                        server.errors += 1
+                    self.reply(503 if not any(bond in bad_bonds for bond in ids) else 400)
+                    return
+                body = json.dumps({root: {bond: build(bond) for bond in ids}}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/{name}"
+        threading.Thread(target=self.httpd.serve_forever, name=f'mock-{name}', daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+
+# Stand-in for dbconnection.DB: serves the universe as sp_GetBondForRates would and records every write
+class FakeDB:
+
+    def __init__(self, universe, row_latency=0.0, trades_per_bond=1):
+        self.universe=universe
+        self.trades_per_bond=int(trades_per_bond)    # sp_GetBondForRates returns a bond once per trade
+        self.row_latency=float(row_latency)      # seconds per written row, simulates the staging insert + UPDATE
+        self.writes=[]                           # (rows, distinct AsOfDates, seconds) per save_data call
+        self.flags=0
+
+    def iterSecuritiesToCheckRates(self, asofdate):
+        for _ in range(self.trades_per_bond):
+            yield from self.universe.bonds()
+
+    def fetchSecuritiesToCheckRatesByDate(self, asofdates):
+        return {bond: list(asofdates) for bond in self.universe.bonds()}
+
+    def save_data(self, security_api_data):
+        with metrics.timer('db_save'):
+            start = perf_counter()
+            parameters = security_api_data.parameters()     # same python side work as DB.save_data
+            sleep(self.row_latency * len(parameters))
+            self.writes.append((len(parameters), len({row[1] for row in parameters}), perf_counter() - start))
+        metrics.count('db_rows_staged', len(parameters))
+        return len(parameters)
+
+    def setRerateData(self, asofdate):
+        with metrics.timer('db_flag'):
+            self.flags += 1
+        return 0
+
+    def close(self):
+        pass
+
+
+
+def run_benchmark(options, log):
+    from fetch_security_details import SecurityAPI
+    from fetch_coupon_details import CouponAPI
+    from fetch_pipeline import FetchPipeline
+
+    as_of = date.today()
+    AsOfDates = [(as_of - timedelta(days=day)).isoformat() for day in reversed(range(options.dates))]
+    universe = Universe(options.bonds, options.history, as_of)
+    bad_bonds = set(random.Random(7).sample(range(options.bonds), min(options.bad_bonds, options.bonds)))
+    bad_bonds = {f"BND{i:07d}" for i in bad_bonds}
+    servers = [MockAPIServer(name, universe, options.latency, options.jitter, options.error_rate, bad_bonds, options.throttle_above) for name in ('security', 'coupon')]
+    db = FakeDB(universe, options.db_row_latency, options.trades_per_bond)
+
+    api_options = dict(
+        max_concurrency=options.max_concurrency, timeout=30, batch_size=options.batch_size,
+        min_batch_size=options.min_batch_size, max_batch_size=options.max_batch_size, json_parser=options.json_parser,
+        initial_concurrency=options.initial_concurrency or options.workers, adaptive_concurrency=not options.fixed_concurrency
+    )
+    security_api = SecurityAPI(servers[0].url, 'token', 'user', 'pwd', log, **api_options)
+    coupon_api = CouponAPI(servers[1].url, 'token', 'user', 'pwd', log, **api_options)
+    pipeline = FetchPipeline(
+        security_api, coupon_api, db, log, chunk_size=options.chunk_size, max_workers=options.workers, engine=options.engine,
+        backoff_base=0.05, backoff_max=1, max_failed_bonds=options.bonds, save_rows=options.save_rows
+    )
+
+    if options.profile:
+        from profiling import profiler
+        profiler.start()
+    start = perf_counter()
+    try:
+        if len(AsOfDates) > 1:
+            bond_dates = db.fetchSecuritiesToCheckRatesByDate(AsOfDates)
+            rows = pipeline.run(iter(bond_dates), f"{AsOfDates[0]}_{AsOfDates[-1]}", bond_dates)
+        else:
+            rows = pipeline.run(db.iterSecuritiesToCheckRates(AsOfDates[0]), AsOfDates[0])
+        db.setRerateData(AsOfDates[-1])
+    finally:
+        elapsed = perf_counter() - start
+        if options.profile:
+            for path in profiler.stop(options.profile, 'benchmark'):
+                print(f"Profile written to {path}")
+        security_api.close()
+        coupon_api.close()
+        for server in servers:
+            server.close()
+
+    return report(options, elapsed, rows, pipeline, servers, db)
+
+
+
+# End-to-end + per stage numbers. Stage throughput is bonds (rows for db_save) per second of time spent in the stage,
+# api stages overlap each other and the db writer, so their sum is more than the wall clock time.
+def report(options, elapsed, rows, pipeline, servers, db):
+    summary = metrics.summary()
+    stages = {}
+    for name, items in (('security_api', 'security_api_bonds'), ('coupon_api', 'coupon_api_bonds'), ('merge', 'bonds'), ('db_save', 'db_rows_staged')):
+        stat = summary['timings'].get(name)
+        if stat:
+            stages[name] = dict(stat, items=summary['counters'].get(items, 0),
+                                per_second=round(summary['counters'].get(items, 0) / stat['total'], 1) if stat['total'] else None)
+    return {
+        'options': vars(options),
+        'elapsed': round(elapsed, 3),
+        'bonds': pipeline.bond_count,
+        'rows_saved': rows,
+        'bonds_per_second': round(pipeline.bond_count / elapsed, 1) if elapsed else None,
+        'bonds_failed': len(pipeline.failures),
+        'requests': {server.name: {'requests': server.requests, 'errors': server.errors, 'throttled': server.throttled, 'peak_in_flight': server.peak_in_flight}
+                     for server in servers},
+        'concurrency': {api.name: api.concurrency.summary() for api in (pipeline.security_api, pipeline.coupon_api)},
+        'db_writes': {
+            'calls': len(db.writes),
+            'rows_per_call': round(sum(write[0] for write in db.writes) / len(db.writes), 1) if db.writes else 0,
+            'max_rows_per_call': max((write[0] for write in db.writes), default=0),
+            'dates_per_call': max((write[1] for write in db.writes), default=0),
+            'flag_calls': db.flags
+        },
+        'batch_sizes': {api.name: api.batcher.summary() for api in (pipeline.security_api, pipeline.coupon_api)},
+        'stages': stages,
+        'counters': summary['counters']
+    }
+
+
+
+def print_report(result):
+    print(f"\n{result['bonds']} bonds in {result['elapsed']:.2f}s -> {result['bonds_per_second']} bonds/s, "
+          f"{result['rows_saved']} rows saved, {result['bonds_failed']} bonds failed")
+    for name, counts in result['requests'].items():
+        print(f"  {name} api: {counts['requests']} requests, {counts['errors']} errors ({counts['throttled']} throttled), peak {counts['peak_in_flight']} in flight")
+    for name, stat in result['stages'].items():
+        print(f"  {name:<13} {stat['count']:>7} x  total {stat['total']:>8.2f}s  p50 {stat['p50']:.4f}s  p95 {stat['p95']:.4f}s  "
+              f"p99 {stat['p99']:.4f}s  {stat['per_second']}/s")
+    writes = result['db_writes']
+    print(f"  db writes: {writes['calls']} calls, {writes['rows_per_call']} rows/call (max {writes['max_rows_per_call']}), "
+          f"up to {writes['dates_per_call']} dates/call, {writes['flag_calls']} flag calls")
+    for summary in list(result['batch_sizes'].values()) + list(result['concurrency'].values()):
+        print(f"  {summary}")
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of security + coupon fetch pipeline with mock APIs and a fake db")
+    parser.add_argument("--bonds", type=int, default=10000, help="Size of the synthetic bond universe (1k - 1M)")
+    parser.add_argument("--dates", type=int, default=1, help="AsOfDates per run (> 1 runs a backfill)")
+    parser.add_argument("--history", type=int, default=30, help="Coupon records (days) per bond")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock api latency per request in seconds")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Mock api latency jitter (+-) in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of mock api requests failing with 503")
+    parser.add_argument("--throttle-above", type=int, default=0, help="Mock apis answer 429 above this many requests in flight (0 = never)")
+    parser.add_argument("--bad-bonds", type=int, default=0, help="Bonds whose batches always fail with 400")
+    parser.add_argument("--trades-per-bond", type=int, default=1, help="Times each bond is returned by the fake db (one row per trade)")
+    parser.add_argument("--db-row-latency", type=float, default=0.0, help="Seconds per row written by the fake db")
+    parser.add_argument("--engine", choices=('thread', 'async'), default='thread')
+    parser.add_argument("--workers", type=int, default=10, help="[FETCH] max_workers")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Per api max_concurrency (ceiling of the adaptive limit)")
+    parser.add_argument("--initial-concurrency", type=int, help="Per api initial_concurrency (default --workers)")
+    parser.add_argument("--fixed-concurrency", action="store_true", help="Disable adaptive concurrency (fixed at --max-concurrency)")
+    parser.add_argument("--chunk-size", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--min-batch-size", type=int, default=5)
+    parser.add_argument("--max-batch-size", type=int, default=200)
+    parser.add_argument("--json-parser", choices=('auto', 'json', 'orjson', 'stream'), default='auto')
+    parser.add_argument("--save-rows", type=int, default=5000)
+    parser.add_argument("--profile", metavar="DIR", help="Write per stage CPU profiles + allocation report into this folder")
+    parser.add_argument("--output", help="Write the result as json to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show pipeline logs")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if options.verbose else logging.ERROR, format='%(asctime)s - %(levelname)-8s - %(message)s')
+    result = run_benchmark(options, logging.getLogger("benchmark"))
+    print_report(result)
+    if options.output:
+        with open(options.output, 'w', encoding='utf-8') as file:
+            json.dump(result, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
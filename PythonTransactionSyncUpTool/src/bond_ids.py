@@ -0,0 +1,109 @@
+# Bond ID normalization + request coalescing.
+# sp_GetBondForRates returns one row per trade, so the same bond comes several times: IDs are canonicalized and
+# de-duplicated before batching, each bond is fetched once and the one staged row updates all of its trade rows
+# in tbl_RerateRecon (UPDATE joins on BOND + AsOfDate). Case is kept as is, the APIs match IDs exactly.
+# SingleFlight lets concurrent requesters of the same bond (overlapping runs/requests on one api) share one call.
+
+from threading import Lock
+from concurrent.futures import Future
+
+
+# ' XS123 ' -> 'XS123', ints/decimals from the db -> str, None/empty -> None
+def normalize_id(security):
+    if security is None:
+        return None
+    if isinstance(security, bytes):
+        security = security.decode('utf-8', 'replace')
+    security = str(security).strip()
+    return security or None
+
+
+# Distinct normalized IDs in input order (generator, keeps the input streaming), 'stats' counts what was dropped
+def unique_ids(securityIDList, stats=None):
+    seen = set()
+    stats = stats if stats is not None else {}
+    stats.setdefault('duplicate', 0)
+    stats.setdefault('invalid', 0)
+    for security in securityIDList:
+        bond = normalize_id(security)
+        if bond is None:
+            stats['invalid'] += 1
+        elif bond in seen:
+            stats['duplicate'] += 1
+        else:
+            seen.add(bond)
+            yield bond
+
+
+# Backfill map with normalized keys, dates of IDs normalizing to the same bond are merged
+def normalize_bond_dates(bond_dates):
+    normalized = {}
+    for security, dates in bond_dates.items():
+        bond = normalize_id(security)
+        if bond is not None:
+            known = normalized.setdefault(bond, [])
+            known.extend(date for date in dates if date not in known)
+    return normalized
+
+
+
+# The bond ended on the failure list of the caller that fetched it, its waiters list it as failed too
+class BondFailed(Exception):
+    pass
+
+
+
+class SingleFlight:
+
+    def __init__(self):
+        self.lock=Lock()
+        self.calls={}       # bond -> Future of its records while a request for it is in flight
+
+
+    # Splits securities into (bonds this caller has to fetch, {bond: Future} of bonds already being fetched by another caller)
+    def claim(self, securityList):
+        owned, shared = [], {}
+        with self.lock:
+            for security in securityList:
+                if security in self.calls:
+                    shared[security] = self.calls[security]
+                else:
+                    self.calls[security] = Future()
+                    owned.append(security)
+        return owned, shared
+
+
+    # Hands the records of the owned bonds to their waiters (records are tuples starting with the bondId),
+    # 'failed' = {bond: error} of owned bonds that failed, their waiters get BondFailed
+    def resolve(self, owned, records, failed=None):
+        failed = failed or {}
+        by_bond = {}
+        for record in records:
+            by_bond.setdefault(normalize_id(record[0]), []).append(record)
+        with self.lock:
+            futures = [(security, self.calls.pop(security)) for security in owned if security in self.calls]
+        for security, future in futures:
+            if security in failed:
+                future.set_exception(BondFailed(failed[security]))
+            else:
+                future.set_result(by_bond.get(security, []))
+
+
+    # Owner failed, waiters get the same error
+    def fail(self, owned, error):
+        with self.lock:
+            futures = [self.calls.pop(security) for security in owned if security in self.calls]
+        for future in futures:
+            future.set_exception(error)
+
+
+    # Records of the shared bonds + {bond: error} of those that failed for their owner
+    @staticmethod
+    def results(shared):
+        records, failed = [], {}
+        for security, future in shared.items():
+            try:
+                records += future.result()
+            except BondFailed as e:
+                failed[security] = e
+        return records, failed
@@ -23,7 +23,21 @@ def read_cfg(log, ini_path=None):
     config = ConfigParser()
     config.read(ini_path)
 
-    sms = SMS(config.get('sms', 'exe_path'), log)
+    # Secrets are cached (encrypted) next to the other local caches for 'cache_ttl' seconds
+    cache_dir = config.get('CACHE', 'dir', fallback='')
+    sms = SMS(
+        config.get('SMS', 'exe_path'), log,
+        timeout=config.get('SMS', 'timeout', fallback=60),
+        max_workers=config.get('SMS', 'max_workers', fallback=8),
+        cache_path=join(cache_dir, 'sms_cache.bin') if cache_dir else None,
+        cache_ttl=config.get('SMS', 'cache_ttl', fallback=0)
+    )
+
+    # All *_key values resolved at once (in parallel) instead of one exe call after another
+    secrets = sms.get_many([
+        value for section in config._sections.values() for key, value in section.items()
+        if key.lower().endswith('_key')
+    ])
 
     def map_key(k, _):
         k=k.lower()
@@ -31,14 +45,18 @@ def read_cfg(log, ini_path=None):
             k=k[:-4]
         return k
     
+    # Plain values are typed without eval: int, float, True/False/None, everything else stays a string
+    literals = {'True': True, 'False': False, 'None': None}
+
     def map_value(k,v):
-        if k.lower().emdswith('_key'):
-            return sms.get(v)
-        else:
-            for c in [float, int, eval]:
-                try:
-                    if str(c(v)) == v: return c(v)
-                except:
-                    pass
+        if k.lower().endswith('_key'):
+            return secrets.get(v)
+        if v in literals:
+            return literals[v]
+        for c in [int, float]:
+            try:
+                if str(c(v)) == v: return c(v)
+            except ValueError:
+                pass
         return v
-    return mapd(config.__dict__['_section'], map_key, map_value)
\ No newline at end of file
+    return mapd(config._sections, map_key, map_value)
\ No newline at end of file
@@ -0,0 +1,103 @@
+# Local checkpoint store (SQLite) for resumable runs keyed by AsOfDate.
+# Every completed api batch is recorded with its parsed result per bond and stage ('security', 'coupon'),
+# and bonds written into database are recorded under stage 'save'.
+# With --resume the next run for the same AsOfDate skips saved bonds, replays cached api results
+# straight into merge + save and only calls the APIs for what is left.
+
+import json
+import sqlite3
+from os import makedirs
+from os.path import dirname
+from threading import Lock
+from json_parser import to_json
+
+
+class CheckpointStore:
+
+    def __init__(self, path, AsOfDate, log, resume=False):
+        self.log=log
+        self.path=path
+        self.AsOfDate=AsOfDate
+        self.lock=Lock()
+
+        makedirs(dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)     # shared by api worker threads, guarded by lock
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                as_of_date TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                bond TEXT NOT NULL,
+                payload TEXT,
+                PRIMARY KEY (as_of_date, stage, bond)
+            )
+        """)
+
+        if resume:
+            counts = dict(self.connection.execute(
+                "SELECT stage, COUNT(*) FROM checkpoint WHERE as_of_date = ? GROUP BY stage", (AsOfDate,)
+            ).fetchall())
+            if counts:
+                self.log.info(f"Resuming {AsOfDate} from checkpoint {path}: {counts}")
+            else:
+                self.log.warning(f"--resume found no checkpoint for {AsOfDate} in {path}, the whole run is done again")
+        else:
+            with self.lock, self.connection:
+                self.connection.execute("DELETE FROM checkpoint WHERE as_of_date = ?", (AsOfDate,))
+            self.log.debug(f"Checkpoint for {AsOfDate} reset in {path}")
+
+
+
+    # Bonds already recorded for the stage
+    def completed(self, stage):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT bond FROM checkpoint WHERE as_of_date = ? AND stage = ?", (self.AsOfDate, stage)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+
+
+    # Cached records of the given bonds for a stage -> (records, bonds found in checkpoint)
+    def load(self, stage, securityList):
+        records = []
+        found = set()
+        with self.lock:
+            for i in range(0, len(securityList), 500):     # stay below sqlite host parameter limit
+                part = securityList[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT bond, payload FROM checkpoint WHERE as_of_date = ? AND stage = ? AND bond IN ({','.join('?' * len(part))})",
+                    (self.AsOfDate, stage, *part)
+                ).fetchall()
+                for bond, payload in rows:
+                    found.add(bond)
+                    records += json.loads(payload) if payload else []
+        return records, found
+
+
+
+    # Records parsed result of a completed batch, bonds without any record are stored as empty (nothing to fetch again)
+    def record(self, stage, securityList, records):
+        by_bond = {security: [] for security in securityList}
+        for record in records:
+            by_bond.setdefault(record[0], []).append(record)      # records are tuples, bondId first
+        rows = [(self.AsOfDate, stage, bond, json.dumps(bond_records, default=to_json)) for bond, bond_records in by_bond.items() if bond is not None]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO checkpoint VALUES (?, ?, ?, ?)", rows)
+
+
+
+    # Bonds written into database
+    def record_saved(self, securityList):
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO checkpoint VALUES (?, 'save', ?, NULL)",
+                [(self.AsOfDate, security) for security in securityList]
+            )
+
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,71 @@
+# Columnar transform stage: merged (security + coupon) rows kept as typed column buffers instead of dataframes.
+# Api parsers return compact records (tuples, bondId first), coupon records are joined to security records
+# with a hash index on bondId and the columns are handed to the db layer as parameter arrays (no iterrows,
+# no intermediate dict lists or dataframe copies).
+#   security record: (bondId, rate)
+#   coupon record:   (bondId, rate, EffectiveDate, cpnSource), resolved from the bond's coupon schedule for the AsOfDate
+
+from array import array
+
+
+class RateColumns:
+
+    def __init__(self):
+        self.bondId=[]                  # str
+        self.AsOfDate=[]                # str, rows of several dates in backfill mode
+        self.rate=array('d')            # float (contiguous doubles)
+        self.EffectiveDate=[]           # str or None
+
+
+    def __len__(self):
+        return len(self.bondId)
+
+
+    def append(self, bondId, AsOfDate, rate, EffectiveDate):
+        self.bondId.append(bondId)
+        self.AsOfDate.append(AsOfDate)
+        self.rate.append(float(rate or 0))
+        self.EffectiveDate.append(None if EffectiveDate is None else str(EffectiveDate))
+
+
+    def extend(self, other):
+        self.bondId += other.bondId
+        self.AsOfDate += other.AsOfDate
+        self.rate += other.rate
+        self.EffectiveDate += other.EffectiveDate
+
+
+    # Keeps rows where mask is True
+    def filter(self, mask):
+        columns = RateColumns()
+        for keep, row in zip(mask, self.rows()):
+            if keep:
+                columns.append(*row)
+        return columns
+
+
+    # (bondId, AsOfDate, rate, EffectiveDate) per row
+    def rows(self):
+        return zip(self.bondId, self.AsOfDate, self.rate, self.EffectiveDate)
+
+
+    # db parameters (BOND, AsOfDate, APIRate, CpnEffectiveDate) per row
+    def parameters(self):
+        return list(self.rows())
+
+
+
+# Join security records with coupon EffectiveDate on bondId (left join, all security records are kept) into rows of the AsOfDate.
+# Bonds in 'exclude' (failed on any api) are left out, so their db rows are not overwritten with partial data.
+# One row per bond (first security record), the staged rows update tbl_RerateRecon joined on BOND + AsOfDate.
+def merge_records(security_records, coupon_records, AsOfDate, exclude=()):
+    effective_dates = {record[0]: record[2] for record in coupon_records}       # hash index on bondId
+    columns = RateColumns()
+    merged = set()
+    for record in security_records:
+        bondId = record[0]
+        if bondId is None or bondId in exclude or bondId in merged:     # BOND is NOT NULL in the staging table, one such row fails the whole save
+            continue
+        merged.add(bondId)
+        columns.append(bondId, AsOfDate, record[1], effective_dates.get(bondId))
+    return columns
@@ -0,0 +1,127 @@
+# Adaptive (AIMD) concurrency limit per api endpoint, one controller per api, used by both engines.
+# Parallel requests start at 'initial_concurrency' and grow by one after every 'limit' successful responses
+# (about once per round trip) while latency stays below 'latency_spike' x the usual latency (additive increase),
+# only when the limit was actually reached since the last change (no growth while the workers are the bottleneck).
+# 429/503/504, timeouts or a latency spike halve the limit (multiplicative decrease), at most once per round trip
+# so one burst of failed requests that were already in flight counts once, every failure restarts the growth count.
+# Never above 'max_concurrency' (ceiling) or below 'min_concurrency'. adaptive_concurrency=False keeps the limit
+# fixed at max_concurrency.
+
+from time import monotonic
+from threading import Condition
+
+
+class ConcurrencyController:
+
+    decrease_factor = 0.5
+    baseline_weight = 0.1       # usual latency is an ewma, follows slow drift but not single slow responses
+    min_cooldown = 0.1          # seconds between two decreases (at least one usual round trip)
+
+    def __init__(self, name, log, max_concurrency=100, min_concurrency=1, initial_concurrency=None, latency_spike=3, adaptive=True):
+        self.name=name
+        self.log=log
+        self.max_limit=max(1, int(max_concurrency))
+        self.min_limit=min(max(1, int(min_concurrency)), self.max_limit)
+        self.adaptive=str(adaptive).lower() in ('true', '1', 'yes')
+        initial = self.max_limit if not self.adaptive or not initial_concurrency else int(initial_concurrency)
+        self.limit=float(min(max(initial, self.min_limit), self.max_limit))
+        self.latency_spike=float(latency_spike)
+        self.condition=Condition()
+        self.in_flight=0                # requests running
+        self.peak=0                     # most requests running at once since the last change
+        self.successes=0                # successful responses since last change
+        self.baseline=None              # usual latency in seconds
+        self.cooldown_until=0.0
+        self.increases=0
+        self.decreases=0
+        self.lowest=self.highest=int(self.limit)
+
+
+    @property
+    def current(self):
+        return int(self.limit)
+
+
+    # Thread engine: blocks while 'limit' requests of this api are in flight
+    def __enter__(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self._started()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.finished()
+
+
+    # Async engine waits on the event loop itself (async_engine.EndpointLimiter), only the count is kept here
+    def started(self):
+        with self.condition:
+            self._started()
+
+    def finished(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _started(self):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+
+
+
+    # Successful response after 'elapsed' seconds
+    def record(self, elapsed):
+        if not self.adaptive:
+            return
+        with self.condition:
+            if self.baseline is None:
+                self.baseline = elapsed
+            if elapsed > self.latency_spike * max(self.baseline, 0.01):
+                self._decrease(f'latency spike {elapsed:.2f}s, usual {self.baseline:.2f}s')
+                self.baseline += self.baseline_weight * (elapsed - self.baseline)
+                return
+            self.baseline += self.baseline_weight * (elapsed - self.baseline)
+            self.successes += 1
+            if self.successes >= int(self.limit) and self.peak >= int(self.limit) and int(self.limit) < self.max_limit:
+                self.successes = 0
+                self.increases += 1
+                self._set(self.limit + 1)
+                self.log.debug(f"{self.name} api concurrency -> {int(self.limit)} (healthy, latency {self.baseline:.2f}s)")
+                self.condition.notify_all()
+
+
+    # Throttled / overloaded: 'reason' is 'timeout' or 'HTTP 429' / 'HTTP 503' / 'HTTP 504'
+    def record_failure(self, reason):
+        if not self.adaptive:
+            return
+        with self.condition:
+            self._decrease(reason)
+
+
+
+    def _decrease(self, reason):
+        now = monotonic()
+        self.successes = 0
+        if now < self.cooldown_until:
+            return
+        self.cooldown_until = now + max(self.baseline or 0.0, self.min_cooldown)
+        previous = int(self.limit)
+        self._set(self.limit * self.decrease_factor)
+        if int(self.limit) != previous:
+            self.decreases += 1
+            self.log.info(f"{self.name} api concurrency {previous} -> {int(self.limit)} ({reason})")
+
+
+    def _set(self, limit):
+        self.limit = float(min(max(limit, self.min_limit), self.max_limit))
+        self.peak = self.in_flight
+        self.lowest = min(self.lowest, int(self.limit))
+        self.highest = max(self.highest, int(self.limit))
+
+
+    def summary(self):
+        with self.condition:
+            if not self.adaptive:
+                return f"{self.name} api concurrency fixed at {int(self.limit)}"
+            return (f"{self.name} api concurrency now {int(self.limit)} (range {self.lowest}-{self.highest}, ceiling {self.max_limit}), "
+                    f"{self.increases} increases, {self.decreases} decreases")
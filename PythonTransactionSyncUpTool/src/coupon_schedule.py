@@ -0,0 +1,71 @@
+# Coupon schedule per asset: every coupon record returned by the coupon api, kept compact because schedules of the
+# whole bond history sit in the response cache: EffectiveDates as date ordinals in array('i') sorted ascending,
+# cpn in a parallel array('d') (NaN = no coupon) and interned cpnSource strings (the same few sources repeat).
+# Schedules are what the coupon api caches and checkpoints, the latest coupon on or before the run's AsOfDate
+# is resolved by binary search, so a cached schedule answers any AsOfDate without fetching or parsing again.
+#   schedule record: (bondId, array('i') [EffectiveDate ordinal, ...], array('d') [cpn, ...], [cpnSource, ...])
+#   resolved record: (bondId, cpn, EffectiveDate, cpnSource)
+# Persisted schedules (json) come back as plain lists, load_schedule makes them compact again.
+
+from array import array
+from bisect import bisect_right
+from datetime import date
+from operator import itemgetter
+from sys import intern
+
+
+def ordinal(EffectiveDate):
+    return date.fromisoformat(str(EffectiveDate)[:10]).toordinal()
+
+
+# entries: (EffectiveDate, cpn, cpnSource) in any order
+def build_schedule(bondId, entries):
+    entries = sorted(((ordinal(EffectiveDate), cpn, cpnSource) for EffectiveDate, cpn, cpnSource in entries), key=itemgetter(0))
+    return (
+        bondId,
+        array('i', [entry[0] for entry in entries]),
+        array('d', [float('nan') if entry[1] is None else entry[1] for entry in entries]),
+        [intern(str(entry[2] or '')) for entry in entries]
+    )
+
+
+# Schedule read back from json (cache / checkpoint), dates are ordinals or ISO strings (written before ordinals)
+def load_schedule(record):
+    bondId, dates, cpns, sources = record
+    if dates and isinstance(dates[0], str):
+        return build_schedule(bondId, zip(dates, cpns, sources))
+    return (
+        bondId,
+        array('i', dates),
+        array('d', [float('nan') if cpn is None else cpn for cpn in cpns]),
+        [intern(str(source or '')) for source in sources]
+    )
+
+
+def is_schedule(record):
+    return isinstance(record[1], (array, list))
+
+
+# Latest coupon with EffectiveDate <= AsOfDate ('YYYY-MM-DD' or its ordinal), None when the schedule starts after AsOfDate
+def resolve(schedule, AsOfDate):
+    bondId, dates, cpns, sources = schedule
+    i = bisect_right(dates, AsOfDate if isinstance(AsOfDate, int) else ordinal(AsOfDate))
+    if i == 0:
+        return None
+    cpn = cpns[i - 1]
+    return (bondId, None if cpn != cpn else cpn, date.fromordinal(dates[i - 1]).isoformat(), sources[i - 1])
+
+
+def resolve_all(records, AsOfDate):
+    day = ordinal(AsOfDate)
+    resolved = []
+    for record in records:
+        if not is_schedule(record):     # already resolved (cache/checkpoint written before schedules)
+            resolved.append(record)
+            continue
+        if isinstance(record[1], list):
+            record = load_schedule(record)
+        coupon = resolve(record, day)
+        if coupon is not None:
+            resolved.append(coupon)
+    return resolved
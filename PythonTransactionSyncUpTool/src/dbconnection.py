@@ -1,9 +1,16 @@
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.engine import make_url, URL
 from pyodbc import connect
 from datetime import datetime
-import pandas as pd
+from time import perf_counter
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from threading import Lock
+from socket import gethostname
+from os import makedirs, replace, getpid
+from os.path import dirname
+import json
 import warnings
+from metrics import metrics
+from profiling import profiler
 
 warnings.filterwarnings('ignore')
 timestamp = datetime.now()
@@ -26,88 +33,251 @@ class DB:
     ]
 
 
-    def __init__(self, connection_string, log):
+    def __init__(self, connection_string, log, fetch_chunk_size=5000, pool_size=4, driver_cache=None):
         self.log=log
-        for index, driver in enumerate(DB.drivers, start=1):       # enumerate() is a built-in function which adds an index counter.
+        self.connection_string=connection_string.replace("True", "YES")
+        self.fetch_chunk_size=int(fetch_chunk_size)      # rows pulled per fetchmany while streaming bonds
+        self.driver_cache=driver_cache or None           # json file {hostname: driver} of the driver that worked last time
+        self.driver=None                                 # driver that worked in this process
+        self.pool_size=int(pool_size)                    # connections kept open for streaming / save / flag stages
+        self.pool=LifoQueue()                            # idle connections, most recently used first
+        self.opened=0
+        self.lock=Lock()
+        self.pool.put(self._connect())                   # connect at startup, so a bad connection string fails fast
+        self.opened=1
+
+
+    # Opens a new connection. The driver that worked last time on this host is tried first,
+    # all drivers are only tried one by one when it fails (driver discovery costs failed connection attempts).
+    def _connect(self):
+        preferred = self.driver or self._cached_driver()
+        drivers = [preferred] + [driver for driver in DB.drivers if driver != preferred] if preferred else DB.drivers
+        for index, driver in enumerate(drivers, start=1):       # enumerate() is a built-in function which adds an index counter.
             try:
                 self.log.debug(f'Attempting to connect db using {driver}')
-                connection_string = connection_string.replace("True", "YES")
-                self.connection = connect(f"Driver={{{driver}}};{connection_string};")
-                self.connection.autocommit = True
+                connection = connect(f"Driver={{{driver}}};{self.connection_string};")
+                connection.autocommit = True
                 self.log.info(f'connected to db using {driver}')
-                self.connection.timeout = 6000
-                return
+                connection.timeout = 6000
+                if driver != preferred:
+                    self._remember_driver(driver)
+                self.driver = driver
+                return connection
             except Exception as e:
-                if index < len(DB.drivers):
+                if index < len(drivers):
                     self.log.info(f'failed to connect using {driver}, trying another drivers\n{e}')
                 else:
                     raise e 
 
 
+    def _cached_driver(self):
+        if not self.driver_cache:
+            return None
+        try:
+            with open(self.driver_cache, encoding='utf-8') as file:
+                return json.load(file).get(gethostname())
+        except (OSError, ValueError):
+            return None
+
+
+    def _remember_driver(self, driver):
+        if not self.driver_cache:
+            return
+        try:
+            try:
+                with open(self.driver_cache, encoding='utf-8') as file:
+                    drivers = json.load(file)
+            except (OSError, ValueError):
+                drivers = {}
+            drivers[gethostname()] = driver
+            makedirs(dirname(self.driver_cache) or '.', exist_ok=True)
+            temp_path = f"{self.driver_cache}.{gethostname()}.{getpid()}.tmp"     # own file per process, shards of one host included
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(drivers, file, indent=1)
+            replace(temp_path, self.driver_cache)       # atomic, shards may start at the same time
+            self.log.debug(f'db driver {driver} cached in {self.driver_cache}')
+        except OSError as e:
+            self.log.warning(f'failed to cache db driver in {self.driver_cache}: {e}')
+
+
+
+    # Connection from the pool for one db stage, new connections are opened up to 'pool_size'.
+    # Connections are given back to the pool afterwards, a connection that failed is closed instead.
+    @contextmanager
+    def pooled(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        except BaseException:
+            self._discard(connection)
+            raise
+        else:
+            self.pool.put(connection)
+
+
+    def _acquire(self):
+        try:
+            return self.pool.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            open_new = self.opened < self.pool_size
+            if open_new:
+                self.opened += 1
+        if not open_new:
+            return self.pool.get()      # wait for a connection given back
+        try:
+            return self._connect()
+        except BaseException:
+            with self.lock:
+                self.opened -= 1
+            raise
+
+
+    def _discard(self, connection):
+        with self.lock:
+            self.opened -= 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+    def close(self):
+        while True:
+            try:
+                self._discard(self.pool.get_nowait())
+            except Empty:
+                break
+
+
 
     # Method for saving API data into database
-    # Here, 'security_api_data_df' is basically a Pandas dataframe containing security API data 
-    def save_data(self, security_api_data_df, AsOfDate):
+    # Here, 'security_api_data' is columnar.RateColumns (bondId, AsOfDate, rate, EffectiveDate columns) of merged API data,
+    # rows of several AsOfDates (backfill) are written in the same set-based operation
+    # Rows are bulk inserted into a session temp (staging) table with fast_executemany and applied with one
+    # set-based UPDATE joined on Bond + AsOfDate inside a single transaction, instead of one UPDATE per row.
+    # Join columns of the staging table use the database collation (temp tables default to tempdb's collation).
+    # Returns the real count of tbl_RerateRecon rows updated.
+    def save_data(self, security_api_data):
+        with metrics.timer('db_save'), self.pooled() as connection:
+            try:
+                self.log.info(f'Inserting {len(security_api_data)} rows')
+                cursor = connection.cursor()
+                data_to_insert = security_api_data.parameters()     # (BOND, AsOfDate, APIRate, CpnEffectiveDate) straight from the columns
+
+                connection.autocommit = False
+                cursor.execute("""
+                    IF OBJECT_ID('tempdb..#RerateStage') IS NULL
+                    BEGIN
+                        CREATE TABLE #RerateStage (
+                            [BOND] varchar(50) COLLATE DATABASE_DEFAULT NOT NULL,
+                            [AsOfDate] varchar(20) COLLATE DATABASE_DEFAULT NOT NULL,
+                            [APIRate] decimal(9,2) NULL,
+                            [CpnEffectiveDate] varchar(20) NULL
+                        )
+                        CREATE CLUSTERED INDEX IX_RerateStage ON #RerateStage ([BOND], [AsOfDate])
+                    END
+                    ELSE
+                        TRUNCATE TABLE #RerateStage
+                """)
+
+                cursor.fast_executemany = True
+                cursor.executemany("INSERT INTO #RerateStage ([BOND], [AsOfDate], [APIRate], [CpnEffectiveDate]) VALUES (?, ?, ?, ?)", data_to_insert)
+
+                query = """
+                    UPDATE r
+                    SET r.[APIRate] = s.[APIRate],
+                        r.[CpnEffectiveDate] = s.[CpnEffectiveDate]
+                    FROM [dbo].[tbl_RerateRecon] r
+                    INNER JOIN #RerateStage s ON r.[BOND] = s.[BOND] AND r.[AsOfDate] = s.[AsOfDate]
+                """
+                cursor.execute(query)
+                updated_count = cursor.rowcount
+                connection.commit()
+                metrics.count('db_rows_staged', len(data_to_insert))
+                metrics.count('db_rows_updated', updated_count)
+                self.log.info(f'Updated {updated_count} rows of tbl_RerateRecon for {len(data_to_insert)} bond/AsOfDate rows')
+                return updated_count
+
+            except Exception as e:
+                connection.rollback()
+                self.log.error(f"database write error: {str(e)}")
+                raise SystemExit(-1)
+
+            finally:
+                connection.autocommit = True
+
+
+
+    # Fetch all securities for the given AsOfDate that are eligible for the reports.
+    def fetchSecuritiesToCheckRates(self, asofdate):
+        return list(self.iterSecuritiesToCheckRates(asofdate))     # List of all Securitiess/Bonds.
+
+
+
+    # Streams securities for the given AsOfDate 'fetch_chunk_size' rows at a time (generator).
+    # Holds its own pooled connection, so API calls + db saves can start while rows are still streaming.
+    def iterSecuritiesToCheckRates(self, asofdate):
         try:
-            self.log.info('Inserting data')
-            cursor = self.connection.cursor()
-            data_to_insert = [      # It is a list comprehension that builds a list of tuple.
-                (
-                    row['rate'], 
-                    row['EffectiveDate'],
-                    row['bondId'], 
-                    AsOfDate
-                )
-                for index, row in security_api_data_df.iterrows()
-            ]
-
-            query = """
-                BEGIN
-                    UPDATE [dbo].[tbl_RerateRecon]
-                    SET [APIRate] = ? ,
-                        [CpnEffectiveDate] = ?
-                    WHERE [BOND] = ? AND [AsOfDate] = ? 
-                END
-            """
-
-            cursor.fast_executemany = True
-            cursor.executemany(query, data_to_insert)
-            return len(security_api_data_df)
+            with self.pooled() as connection:
+                yield from self._streamSecurities(connection.cursor(), asofdate)
 
         except Exception as e:
-            self.log.error(f"database write error: {str(e)}")
+            self.log.error(f"Fetching security for rate check error: {str(e)}")
             raise SystemExit(-1)
-    
 
 
-    # Fetch all securities for the given AsOfDate that are eligible for the reports.
-    def fetchSecuritiesToCheckRates(self, asofdate):
-        print("Inside db method asofdate:" + asofdate)
-        self.log.info('Fetching Bonds for rate check')
+
+    # Securities of several AsOfDates (backfill) -> {bond: [asofdate, ...]}, all dates read over one connection.
+    def fetchSecuritiesToCheckRatesByDate(self, asofdates):
+        bond_dates = {}
         try:
-            cursor = self.connection.cursor()   # Creates a DB connection.
-            query = "EXEC sp_GetBondForRates ?" # '?' is a placeholder for asofdate. Ex- EXEC sp_GetBondForRates '2025-08-30'
-            self.log.info(query)
-            cursor.execute(query, asofdate)     # Cursor used to run SQL commands.
-            rows = cursor.fetchall()
-            print(rows)
+            with self.pooled() as connection:
+                cursor = connection.cursor()
+                for asofdate in asofdates:
+                    for security in self._streamSecurities(cursor, asofdate):
+                        bond_dates.setdefault(security, []).append(asofdate)
+            self.log.info(f'Fetched {len(bond_dates)} distinct bonds for rate check over {len(asofdates)} dates')
+            return bond_dates
 
-            securityIDList = [rows[0] for row in rows]  # List of all Securitiess/Bonds.
-            return securityIDList
-        
         except Exception as e:
             self.log.error(f"Fetching security for rate check error: {str(e)}")
             raise SystemExit(-1)
 
 
+    def _streamSecurities(self, cursor, asofdate):
+        self.log.info(f'Fetching Bonds for rate check asofdate: {asofdate}')
+        query = "EXEC sp_GetBondForRates ?" # '?' is a placeholder for asofdate. Ex- EXEC sp_GetBondForRates '2025-08-30'
+        self.log.info(query)
+        start = perf_counter()      # db_read timings: execute + each fetchmany, not the time consumers spend on the rows
+        with profiler.stage('db_read'):
+            cursor.execute(query, asofdate)     # Cursor used to run SQL commands.
+        count = 0
+        while True:
+            with profiler.stage('db_read'):
+                rows = cursor.fetchmany(self.fetch_chunk_size)
+            metrics.observe('db_read', perf_counter() - start)
+            if not rows:
+                break
+            count += len(rows)
+            metrics.count('db_bonds_read', len(rows))
+            self.log.debug(f'Fetched {count} bonds so far')
+            for row in rows:
+                yield row[0]
+            start = perf_counter()
+        self.log.info(f'Fetched {count} bonds for rate check')
+
+
 
     # Method to flag trades that have been re-rated.
     def setRerateData(self, asofdate):
         self.log.info('Fetching Bonds for rate check')
         try:
-            cursor = self.connection.cursor()
-            query = "EXEC sp_set_RerateFlag"
-            result = cursor.execute(query)
+            with metrics.timer('db_flag'), self.pooled() as connection:
+                cursor = connection.cursor()
+                query = "EXEC sp_set_RerateFlag"
+                result = cursor.execute(query)
             return 0
         except Exception as e:
             self.log.error(f"Error while flagging rerated data: {str(e)}")
@@ -1,122 +1,70 @@
-import json
-import math
-import requests
-import pandas as pd
-from datetime import date, datetime
-from requests.auth import HTTPBasicAuth
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from logging import getLogger, CRITICAL
-
-pd.set_option('display.max_rows', None)
-
-
-class CouponAPI:
-    
-    def __init__(self, url, token, user, pwd, log):
-        self.log=log
-        self.url=url
-        self.token=token
-        self.user=user
-        self.pwd=pwd
-        self.request_id=12345678910
-        self.log.debug(f'initialized coupon api {user}@{url}')
-
-
-
-    # Batch processing + Concurrency (parallel execution)
-    def fetch_coupon_details_batch(self, securityIDList):
-        all_securityIDs = []
-        batch_size = 50
-        securityID_batch_list = [securityIDList[i:i + batch_size] for i in range(0, len(securityIDList), batch_size)]
-
-        # Fetch security details for each batch concurrently
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [
-                executor.submit(self.fetch_coupon_details_all, securities, 'BOND')
-                for securities in securityID_batch_list
-            ]
-
-            for future in as_completed(futures):
-                try:
-                    t=future.result()
-                    if isinstance(t, list):
-                        all_securityIDs += t
-                except Exception as e:
-                    self.log.error(f"An error occured during concurrent execution of security API: {str(e)} %s", repr(e))
-                    raise SystemExit(-1)
-                
-        return all_securityIDs
+from api_base import APIBase
+from json_parser import scalar_fields
+from coupon_schedule import build_schedule, load_schedule, is_schedule
 
 
+class CouponAPI(APIBase):
 
+    name = 'coupon'
+    fields = ('assetId', 'cpn', 'cpnEffectiveDate', 'cpnSource')     # only fields used by the mapping
+
+
+    # Fetch coupon details for a list of securities
     def fetch_coupon_details_all(self, securityList:list, bondClass='BOND'):
+        return self.fetch_all(securityList, bondClass)
+
+
+    # Map coupon API response into coupon schedules [(bondId, EffectiveDates, rates, cpnSources)] (compact, coupon_schedule.py),
+    # the coupon of the run's AsOfDate is resolved from the schedule later (coupon_schedule.py)
+    def parse(self, data, securityIDList):
         coupon_data = []
-        securityIDList = ""
-        for security in securityList:
-            if isinstance(security, str):
-                securityIDList += security + ","
-
-        headers = {
-            'Content-Type':'application/json',
-            'Request-ID':str(self.request_id),
-            'Origin-Timestamp':datetime.now().isoformat(timespec='milliseconds') + 'Z',
-            'API-Key':self.token
-        }
-
-        params = {
-            'bondId':securityIDList,
-            'bondIdType':bondClass
-        }
-
-        try:
-            response = requests.get(
-                self.url,
-                headers=headers,
-                params=params,
-                auth=HTTPBasicAuth(self.user, self.pwd)
-            )
-            response.raise_for_status()
-
-        except requests.exceptions.RequestException as e:
-            self.log.error(f"Request error on {self.url} for {securityIDList}: {str(e)} %s", repr(e))
-            raise SystemExit(-1)
-        
-        try:
-            data = response.json()
-            as_of_dt = datetime.today().date()
-            coupon_details = data.get('couponDataByAssetId', {})
-            if not coupon_details:
-                self.log.info(f"No coupon data found for securities: {securityIDList}. Skipping...")
-                return []
-            
-            for security_key, coupon_detail in coupon_details.items():
-                coupon_record = coupon_detail.get('couponEffectiveDate', {})
-                if not coupon_record:
-                    self.log.info(f"No coupon effective date for securities: {securityIDList}. Skipping...")
-                    continue
-
-                latest_record = None
-                latest_date = None
-                for coupon_record_key, coupon_record_details in coupon_detail.items():
-                    if coupon_record_key=='assetId' or type(coupon_record_details) is str:
-                        continue
-
-                    # logic to fetch most recent coupon EffectiveDate <= Todays_Date per assetId
-                    effective_dt = datetime.strptime(coupon_record_key, "%Y-%m-%d").date()
-                    if effective_dt <= as_of_dt:
-                        if latest_date is None or effective_dt > latest_date:
-                            latest_date = effective_dt
-                            latest_record = coupon_record_details
-
-                if latest_record:
-                    coupon_data.append({
-                        "bondId": securityIDList,
-                        "rate": latest_record.get('cpn', 0),
-                        "EffectiveDate": latest_record.get('EffectiveDate'),
-                        "cpnSource": latest_record.get('cpnSource', '')
-                    })
-            return coupon_data    # List of tuples
-
-        except Exception as e:
-            self.log.error(f"Mapping error for {securityIDList}: {str(e)} %s")
-            raise SystemExit(-1) 
+        coupon_details = data.get('couponDataByAssetId', {})
+        if not coupon_details:
+            self.log.info(f"No coupon data found for securities: {securityIDList}. Skipping...")
+            return []
+
+        for security_key, coupon_detail in coupon_details.items():
+            coupon_record = coupon_detail.get('couponByEffectiveDate', {})
+            if not coupon_record:
+                self.log.info(f"No coupon effective date for security: {security_key}. Skipping...")
+                continue
+
+            coupon_data.append(build_schedule(
+                coupon_detail.get('assetId', security_key),
+                (self.coupon_entry(coupon_record_key, coupon_record_details)
+                 for coupon_record_key, coupon_record_details in coupon_record.items() if type(coupon_record_details) is dict)
+            ))
+        return coupon_data    # List of tuples
+
+
+    # Same mapping straight from the raw response bytes (json_parser=stream)
+    def parse_stream(self, content, securityIDList):
+        assets = {}
+        schedules = {}
+        for path, field, value in scalar_fields(content, 'couponDataByAssetId', self.fields):
+            if len(path) == 1 and field == 'assetId':
+                assets[path[0]] = value
+            elif len(path) == 3 and path[1] == 'couponByEffectiveDate':
+                schedules.setdefault(path[0], {}).setdefault(path[2], {})[field] = value
+
+        if not schedules:
+            self.log.info(f"No coupon data found for securities: {securityIDList}. Skipping...")
+        return [
+            build_schedule(assets.get(security_key, security_key), (self.coupon_entry(key, record) for key, record in coupon_record.items()))
+            for security_key, coupon_record in schedules.items()
+        ]
+
+
+    # Schedules from the persistent cache are json lists, made compact again before they are kept in memory
+    def load_records(self, records):
+        return [load_schedule(record) if is_schedule(record) else record for record in records]
+
+
+    # (EffectiveDate, rate, cpnSource) of one coupon record, keyed by its effective date
+    @staticmethod
+    def coupon_entry(coupon_record_key, record):
+        return (
+            record.get('cpnEffectiveDate') or coupon_record_key,
+            record.get('cpn', 0),
+            record.get('cpnSource', '')
+        )
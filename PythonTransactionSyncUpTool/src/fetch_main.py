@@ -1,120 +1,331 @@
 
+# Entry point of RerateDataLoader.exe. Kept light on purpose: only stdlib modules are imported at load time,
+# arguments are parsed first (--help / bad arguments exit before anything is loaded), and heavy modules
+# (pyodbc, requests, aiohttp, json parsers, pipeline) are imported by the stage that needs them.
+from time import perf_counter
+started = perf_counter()     # startup is measured from here to db connected
+
 import argparse   # used for parsing the command line arguments.
-from datetime import datetime, time, timedelta                  
-from concurrent.futures import ThreadPoolExecutor, as_completed # run multiple tasks in parallel (multi-threading).
-import pandas as pd   # data analysis library, often for tabular data (like trades).
-from dbconnection import DB
-from log_handler import init_log
-from fetch_security_details import SecurityAPI
-from fetch_coupon_details import CouponAPI
-from cfg import read_cfg
-from cfg_main import read_cfg   # This is getting used
+from datetime import datetime, timedelta
+from os.path import dirname, join, splitext
+from itertools import chain
+from multiprocessing import freeze_support
+from sharding import parse_shard, shard_of, in_shard, shard_suffix
+
+
+# Step-1: Console application start with 'AsOfDate' as an argument/parameter
+# Returns (args, AsOfDate, AsOfDates of a backfill, shard)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetching security details for the provided BONDs")
+    parser.add_argument("AsOfDate", type=str, nargs="?", help="Date for which the report should run")
+    parser.add_argument("--from", dest="date_from", type=str, help="Backfill: first AsOfDate of the range (with --to)")
+    parser.add_argument("--to", dest="date_to", type=str, help="Backfill: last AsOfDate of the range (with --from)")
+    parser.add_argument("--dates", nargs="+", default=[], metavar="DATE", help="Backfill: list of AsOfDates")
+    parser.add_argument("--resume", action="store_true", help="Resume previous run of the AsOfDate, skipping work already completed")
+    parser.add_argument("--delta", action="store_true", help="Only fetch/write bonds that are new, expired in cache or changed since last run")
+    parser.add_argument("--refresh", nargs="*", default=[], metavar="BOND", help="Bonds to always fetch and write again in --delta mode")
+    parser.add_argument("--processes", type=int, default=1, help="Split bonds over N worker processes (shards), rerate flag runs once all of them completed")
+    parser.add_argument("--shard", type=str, metavar="i/N", help="Only process shard i of N (Ex- 1/4), rerate flag is left to a final --flag-only run")
+    parser.add_argument("--flag-only", action="store_true", help="Only flag re-rated trades (after all --shard runs completed)")
+    parser.add_argument("--profile", action="store_true", help="CPU profile per stage + allocation report into the dated log folder (slows the run down)")
+    parser.add_argument("--serve", action="store_true", help="Stay resident and run AsOfDate jobs on schedule, from the local socket or drop folder ([SERVICE])")
+    args = parser.parse_args(argv)
+
+    try:
+        backfill = args.date_from or args.date_to or args.dates
+        if backfill and args.AsOfDate is not None:
+            parser.error("AsOfDate can not be used together with --from/--to or --dates")
+        if (args.date_from or args.date_to) and args.dates:
+            parser.error("--dates can not be used together with --from/--to")
+        if args.date_from or args.date_to:
+            if not (args.date_from and args.date_to):
+                parser.error("--from and --to must be used together")
+            date_obj = datetime.strptime(args.date_from, "%Y-%m-%d")
+            date_to = datetime.strptime(args.date_to, "%Y-%m-%d")
+            if date_obj > date_to:
+                parser.error(f"--from {args.date_from} is after --to {args.date_to}")
+            AsOfDates = []
+            while date_obj <= date_to:
+                AsOfDates.append(date_obj.strftime("%Y-%m-%d"))
+                date_obj += timedelta(days=1)
+        else:
+            AsOfDates = sorted({datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m-%d") for date in args.dates})
+        if backfill and not AsOfDates:
+            parser.error("Backfill date range is empty")
+
+        if AsOfDates:
+            AsOfDate = AsOfDates[0] if len(AsOfDates) == 1 else f"{AsOfDates[0]}_{AsOfDates[-1]}"    # label of the backfill run
+        elif args.AsOfDate is None:
+            AsOfDate = datetime.now().strftime("%Y-%m-%d")
+        else:
+            date_obj = datetime.strptime(args.AsOfDate, "%Y-%m-%d")
+            AsOfDate = date_obj.strftime("%Y-%m-%d")
+
+        if args.shard and args.processes > 1:
+            parser.error("--shard and --processes can not be used together")
+        shard = parse_shard(args.shard) if args.shard else None
+
+    except ValueError as e:
+        parser.error(str(e))
+
+    return args, AsOfDate, AsOfDates, shard
+
 
 
 def fetch_main():
 
     # Step-0: Variable declarations
+    args, AsOfDate, AsOfDates, shard = parse_args()
     print("Start Application")
+
+    from log_handler import init_log
+    from cfg_main import read_cfg
+    from dbconnection import DB
+    from metrics import metrics
+
     log=init_log()
     config=read_cfg(log)
     log.config(**config['log'])
+    # Driver that worked on this host is remembered next to the other local caches
+    if config.get('cache', {}).get('dir'):
+        config['db'].setdefault('driver_cache', join(config['cache']['dir'], "db_driver.json"))
     db = DB(log=log, **config['db'])
 
-    secapi = SecurityAPI(log=log, **config['secapi'])       # Security API
-    coupon_api = CouponAPI(log=log, **config['coupon_api']) # Coupon API
+    # Startup budget: time to get from process start to a db connection, mostly imports + secrets + driver discovery
+    startup = perf_counter() - started
+    metrics.observe('startup', startup)
+    startup_budget = float(config.get('startup', {}).get('budget', 5))
+    if startup > startup_budget:
+        log.warning(f"Startup took {startup:.2f}s, over budget of {startup_budget:.2f}s")
+    else:
+        log.info(f"Startup took {startup:.2f}s (budget {startup_budget:.2f}s)")
+
+    # Service mode: db pool, api sessions, secrets and caches stay warm between jobs
+    if args.serve:
+        from service import RerateService
+        try:
+            RerateService(config, log, db, **config.get('service', {})).serve()
+        finally:
+            db.close()
+        return
 
+    status = 'failed'
+    try:
+        status = run_job(config, log, db, args, AsOfDate, AsOfDates, shard)
+    finally:
+        db.close()
+        metrics.observe('total', perf_counter() - started)
+        write_metrics(config, log, AsOfDate, shard, status=status, mode='flag-only' if args.flag_only else f'processes={args.processes}')
+
+
+
+# Step-2 to Step-6 for one AsOfDate (or backfill range), returns the run status.
+# 'apis' = already open (SecurityAPI, CouponAPI) of service mode, a single run opens its own.
+def run_job(config, log, db, args, AsOfDate, AsOfDates, shard, apis=None):
+    from metrics import metrics
+
+    profiled = args.profile and start_profile(config, log)
     try:
-        # Step-1: Console application start with 'AsOfDate' as an argument/parameter
         log.info(f"Application Started at {datetime.now()}")
-        parser = argparse.ArgumentParser(description="Fetching security details for the provided BONDs")
-        parser.add_argument("AsOfDate", type=str, help="Date for which the report should run")
-        args = parser.parse_args()
 
-        if args.AsOfDate is None:
-            AsOfDate = datetime.now().strftime("%Y-%m-%d")
-        else:
-            date_obj = datetime.strptime(args.AsOfDate, "%Y-%m-%d")
-            AsOfDate = date_obj.strftime("%Y-%m-%d")
+        if not args.flag_only:
+            # Step-2: Stream list of securities from TransactionDB for which rates need to be fetched,
+            # bonds go straight into the API batches while the rest are still being read.
+            # Backfill reads the bonds of every date first, so each bond is fetched once for the whole range.
+            log.info(f"Fetching securities for rate checks started at {datetime.now()}")
+            bond_dates = None
+            if AsOfDates:
+                bond_dates = db.fetchSecuritiesToCheckRatesByDate(AsOfDates)
+                securities = iter(bond_dates)
+            else:
+                securities = db.iterSecuritiesToCheckRates(AsOfDate)
+            if shard:
+                securities = in_shard(securities, shard)
+            first_security = next(securities, None)
+            if first_security is None:
+                log.info(f"No securities to check on: {AsOfDate}")
+                return 'no securities'
+            securities = chain([first_security], securities)
 
+            # Step-3 to Step-5: fetch + merge + save, in this process or spread over worker processes by bond hash
+            with metrics.timer('fetch'):
+                if args.processes > 1:
+                    result_count = run_shards(config, log, args, AsOfDate, securities, bond_dates, args.processes)
+                else:
+                    result_count = fetch_rates(config, log, db, args, AsOfDate, securities, bond_dates, shard, apis)[1]
 
-        # Step-2: Fetch list of securities from TransactionDB for which rates need to be fetched
-        log.info(f"Fetching securities for rate checks started at {datetime.now()}")
-        securities = db.fetchSecuritiesToCheckRates(AsOfDate)
-        log.info(f"Fetching BONDs for rate checks ends at {datetime.now()}")
+            if shard:
+                log.info(f"Shard {shard[0]}/{shard[1]} completed ({result_count} rows), run --flag-only once all shards completed")
+                return 'completed'
 
+        # Step-6: Flag trades that have been re-rated (once, also for a backfill of several dates or a sharded run)
+        log.info(f"Starting rerate flagging of trades at {datetime.now()}")
+        result_count = db.setRerateData(AsOfDate)
+        log.info(f"Completed rerate flagging of trades at {datetime.now()}")
+        return 'completed'
 
-        try:
-            # Step-3.1: Call security API to fetch rate and set them to a dataframe
-            security_batch_data : list = []     # List collection
-            log.info(f"Starting security API calls at {datetime.now}")
-            security_batch_data = secapi.fetch_security_details_batch(securities)    # List of tuples i.e., [{security, rate}]
-            log.info(f"Completed security API call at {datetime.now()}")
+    except Exception as e:
+        log.error("An error occured %s", repr(e))
+        raise SystemExit(-1)
 
+    finally:
+        if profiled:
+            write_profile(config, log, AsOfDate, shard)
 
-            # Step-3.2: Call Coupon API to fetch Effective_Date for each securities and set them to a dataframe
-            coupon_batch_data : list = []     # List of collection
-            log.info(f"Starting coupon API calls at {datetime.now}")
-            coupon_batch_data = coupon_api.fetch_coupon_details_batch(securities) # List of tuples i.e., [{security, Eff_Date}]
-            log.info(f"Completed coupon API call at {datetime.now()}")
 
 
-            # Step-4: Process the fetched (rate + Eff_Date) and set them to a dataframe
-            if len(security_batch_data) == 0:
-                log.info(f"No securities to check on: {AsOfDate}")
-            else:
-                log.info(f"Count of securities to check for {AsOfDate} : {len(security_batch_data)}")
-                
-                # convert security API result into dataframe
-                security_df = pd.DataFrame(security_batch_data)     # {bondId, rate, asofDt}
-                security_df["asOfDt"] = AsOfDate
-
-                # convert coupon API result into another dataframe
-                if coupon_batch_data and len(coupon_batch_data)>0:  # {bondId, rate, EffectiveDate, Source}
-                    coupon_df = pd.DataFrame(coupon_batch_data)
-                    coupon_df = coupon_df[["bondId", "EffectiveDate"]]
-                else:
-                    log.info(f"No Security with coupon data available for {AsOfDate}")
-                    coupon_df = pd.DataFrame(colulmns=["bondId", "EffectiveDate"])  # This will set empty dataframe
-
-                # merge both dataframe into one based on 'bondId'
-                merged_df = pd.merge(
-                    security_df[["bondId", "rate", "asOfDt"]],
-                    coupon_df,
-                    on="bondId",
-                    how="left"  # Ensures all securities are taken from security_batch_data
-                )
-
-                # define column datatypes
-                column_data_type = {
-                    'asOfDt': object,
-                    'bondId': str,
-                    'rate': float,
-                    'EffectiveDate': str
-                }
-                
-                security_all_data = merged_df.astype(column_data_type)
-                log.info(f"Security & Coupon APIs data conversion to dataframe completed at {datetime.now()}")
-
-
-                # Stpe-5: Save the data into database table
-                log.info(f"Starting db save at {datetime.now()}")
-                result_count = db.save_data(security_all_data, AsOfDate)
-                log.info(f"Completed db save at {datetime.now()}")
-
-                # Step-6: Flag trades that have been re-rated
-                log.info(f"Starting rerate flagging of trades at {datetime.now()}")
-                result_count = db.setRerateData(AsOfDate)
-                log.info(f"Completed rerate flagging of trades at {datetime.now()}")
-
-        except Exception as e:
-            log.error("An error occured %s", repr(e))
-            raise SystemExit(-1)
+# Dated log folder, files of a run (failure list, run summary) are kept next to the log.
+# 'date' = folder of that date instead of today's, the checkpoint lives under its AsOfDate so a resume on a later day finds it
+def run_log_dir(config, date=None):
+    return dirname(config['log']['path'].format(date=date or datetime.now().strftime("%Y-%m-%d")))
+
+
+
+# --profile: stages are profiled from here until write_profile (one profiled run at a time per process)
+def start_profile(config, log):
+    from profiling import profiler
+    if profiler.start(config.get('profile', {}).get('frames', 5)):
+        log.info("Profiling enabled, stages run slower than usual")
+        return True
+    log.warning("Profiling already running for another job, this run is not profiled")
+    return False
+
+
+def write_profile(config, log, AsOfDate, shard=None):
+    from profiling import profiler
+    try:
+        for path in profiler.stop(run_log_dir(config), f"{AsOfDate}{shard_suffix(shard)}", config.get('profile', {}).get('top', 30)):
+            log.info(f"Profile written to {path}")
+    except Exception as e:
+        log.warning(f"Failed to write profile for {AsOfDate}: {e}")
+
+
+
+# Run summary (stage timings p50/p95/p99 + counters) as json next to the dated log and as optional Prometheus textfile
+def write_metrics(config, log, AsOfDate, shard=None, **run):
+    from metrics import metrics
+    try:
+        metrics.log_summary(log)
+        metrics.write_json(join(run_log_dir(config), f"run_summary_{AsOfDate}{shard_suffix(shard)}.json"), AsOfDate=AsOfDate, shard=shard, **run)
+        prometheus_path = config.get('metrics', {}).get('prometheus_path')
+        if prometheus_path:
+            root, extension = splitext(prometheus_path)
+            metrics.write_prometheus(f"{root}{shard_suffix(shard)}{extension}", as_of_date=AsOfDate)
+    except Exception as e:
+        log.warning(f"Failed to write run metrics for {AsOfDate}: {e}")
+
+
+
+# Step-3: Call security + coupon APIs chunk by chunk, both APIs in parallel on one shared thread pool.
+# Step-4: As soon as both halves of a chunk land, merge (rate + Eff_Date) into typed columns and
+# Step-5: save them into database table, while next chunks are still being fetched.
+# Returns (bonds processed, rows saved, bonds failed)
+def fetch_rates(config, log, db, args, AsOfDate, securities, bond_dates=None, shard=None, apis=None):
+    from fetch_pipeline import FetchPipeline     # security + coupon API calls run pipelined (multi-threading).
+    from checkpoint import CheckpointStore
+    from sync_state import SyncState
+
+    secapi, coupon_api = apis or open_apis(config, log)
+
+    try:
+        log.info(f"Starting security & coupon API calls at {datetime.now()}")
+        # Bonds that keep failing on the APIs are skipped and listed next to the dated log, completed batches are
+        # checkpointed in the log folder of the AsOfDate so a failed run can be continued with --resume on any day
+        log_dir = run_log_dir(config)
+        failures_path = join(log_dir, f"failed_bonds_{AsOfDate}{shard_suffix(shard)}.csv")
+        checkpoint_path = join(run_log_dir(config, AsOfDate), f"checkpoint_{AsOfDate}{shard_suffix(shard)}.sqlite")
+        checkpoint = CheckpointStore(checkpoint_path, AsOfDate, log, resume=args.resume)
+        # Last written values per bond are always remembered, so a later --delta run knows what changed
+        sync_state = SyncState(join(config.get('cache', {}).get('dir') or log_dir, "sync_state.sqlite"), log)
+        pipeline = FetchPipeline(secapi, coupon_api, db, log, failures_path=failures_path, checkpoint=checkpoint,
+                                 sync_state=sync_state, delta=args.delta, refresh=args.refresh, **config.get('fetch', {}))
+        result_count = pipeline.run(securities, AsOfDate, bond_dates)
+        checkpoint.close()
+        sync_state.close()
+        log.info(f"Completed security & coupon API calls and db save ({result_count} rows) at {datetime.now()}")
+        return pipeline.bond_count, result_count, len(pipeline.failures)
 
     except Exception as e:
         log.error("An error occured %s", repr(e))
         raise SystemExit(-1)
-    
+
+    finally:
+        if not apis:
+            secapi.close()
+            coupon_api.close()
+
+
+
+def open_apis(config, log):
+    from fetch_security_details import SecurityAPI
+    from fetch_coupon_details import CouponAPI
+
+    # API connection pools default to the api's max_concurrency (APIBase), response caches share one folder
+    for api_config in (config['security_api'], config['coupon_api']):
+        api_config.setdefault('cache_dir', config.get('cache', {}).get('dir'))
+
+    secapi = SecurityAPI(log=log, **config['security_api'])       # Security API
+    coupon_api = CouponAPI(log=log, **config['coupon_api']) # Coupon API
+    return secapi, coupon_api
+
+
+
+# Coordinator of a sharded run: bonds are hash partitioned over 'processes' worker processes, each with its own
+# API sessions + DB connection (CPU bound parsing/merging is not sharing one GIL). Returns total rows saved.
+def run_shards(config, log, args, AsOfDate, securities, bond_dates, processes):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from multiprocessing import get_context
+
+    partitions = {index: [] for index in range(1, processes + 1)}
+    for security in securities:
+        partitions[shard_of(security, processes)].append(security)
+
+    bond_count = result_count = failed_count = 0
+    # spawn: workers start clean (no copy of the coordinator's log listener, db connection or api sessions)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context('spawn')) as executor:
+        futures = {}
+        for index, partition in partitions.items():
+            if not partition:
+                continue
+            partition_dates = {security: bond_dates[security] for security in partition} if bond_dates else None
+            shard = (index, processes)
+            futures[executor.submit(fetch_shard, config, args, AsOfDate, partition, partition_dates, shard)] = shard
+
+        for future in as_completed(futures):
+            shard = futures[future]
+            shard_bonds, shard_rows, shard_failed = future.result()
+            log.info(f"Shard {shard[0]}/{shard[1]} completed: {shard_bonds} bonds, {shard_rows} rows saved, {shard_failed} bonds failed")
+            bond_count += shard_bonds
+            result_count += shard_rows
+            failed_count += shard_failed
+
+    log.info(f"All {len(futures)} shards completed for {AsOfDate}: {bond_count} bonds, {result_count} rows saved, {failed_count} bonds failed")
+    return result_count
+
+
+
+# Worker process of a sharded run, gets the already resolved config so secrets are not looked up again
+def fetch_shard(config, args, AsOfDate, securities, bond_dates, shard):
+    from log_handler import init_log
+    from dbconnection import DB
+
+    log=init_log(session_file=False)
+    log.config(**config['log'])
+    log.info(f"Shard {shard[0]}/{shard[1]} started with {len(securities)} bonds")
+    db = DB(log=log, **config['db'])
+    status = 'failed'
+    profiled = args.profile and start_profile(config, log)
+    try:
+        result = fetch_rates(config, log, db, args, AsOfDate, securities, bond_dates, shard)
+        status = 'completed'
+        return result
+    finally:
+        if profiled:
+            write_profile(config, log, AsOfDate, shard)
+        db.close()
+        write_metrics(config, log, AsOfDate, shard, status=status, mode='worker')
+
 
 if __name__ == "__main__":
+    freeze_support()    # worker processes of the pyinstaller exe
     fetch_main()
-
@@ -0,0 +1,489 @@
+# Pipelined fetch stage for security + coupon APIs.
+# Both APIs' batches for the same chunk of bonds are in flight together on one shared thread pool,
+# and a chunk is merged and handed to the DB writer as soon as both of its halves have landed.
+# Each api splits its half of a chunk into batches sized by its own adaptive batcher (adaptive_batcher.py).
+# Failing batches are retried, then split to isolate bad bond IDs (resilience.py), the rest of the run continues.
+# With a checkpoint store (checkpoint.py) completed batches are recorded, so a resumed run only fetches what is left.
+# Bonds still fresh in the api's response cache (response_cache.py) are not fetched at all.
+# In delta mode (sync_state.py) bonds already written for the AsOfDate with fresh cached data are skipped,
+# and rows whose values did not change since last write are not UPDATEd again.
+# Coupon api returns each bond's coupon schedule, the coupon of the AsOfDate is resolved at merge time (coupon_schedule.py).
+# In backfill mode every bond is fetched once for the whole date range and a row is resolved per AsOfDate it is due on,
+# rows of all dates go through the same buffered save.
+# Merged rows are kept as typed columns (columnar.py), buffered and saved 'save_rows' at a time with one set-based db write (DB.save_data).
+# So wall-clock time is roughly the slower of the two APIs (not the sum), and DB writes overlap with network I/O.
+# engine=thread (default) uses a thread pool, engine=async runs all batches over one asyncio event loop (async_engine.py).
+
+import asyncio
+from time import sleep
+from threading import Event
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from api_base import APIRequestError
+from resilience import RetryPolicy, FailureList
+from sync_state import row_key
+from columnar import RateColumns, merge_records
+from coupon_schedule import resolve_all
+from metrics import metrics
+from profiling import profiler
+from bond_ids import unique_ids, normalize_bond_dates
+
+
+# Splits any iterable of securities into lists of 'chunk_size' (last one can be smaller)
+def chunked(securityIDList, chunk_size):
+    chunk = []
+    for security in securityIDList:
+        chunk.append(security)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+
+class FetchPipeline:
+
+    def __init__(self, security_api, coupon_api, db, log, chunk_size=200, max_workers=10, max_chunks_in_flight=None, engine='thread',
+                 max_attempts=4, backoff_base=1, backoff_max=60, max_failed_bonds=1000, failures_path=None, checkpoint=None,
+                 sync_state=None, delta=False, refresh=(), save_rows=5000):
+        self.log=log
+        self.security_api=security_api
+        self.coupon_api=coupon_api
+        self.db=db
+        # A chunk must be able to hold the largest batch either api may grow to
+        self.chunk_size=max(int(chunk_size), security_api.batcher.max_size, coupon_api.batcher.max_size)
+        # A thread for every request both apis may have in flight at once, their adaptive limits decide how many actually run
+        self.max_workers=max(int(max_workers), security_api.max_concurrency + coupon_api.max_concurrency)
+        self.engine=str(engine).lower()
+        if self.engine not in ('thread', 'async'):
+            raise ValueError(f"Unknown fetch engine '{engine}', expected thread or async")
+        self.retry_policy=RetryPolicy(max_attempts, backoff_base, backoff_max)
+        self.split_attempts=min(2, self.retry_policy.max_attempts)     # halves of a failed batch get fewer attempts, so an api that is down does not multiply retries
+        self.failures=FailureList(log, max_failed_bonds)
+        self.failures_path=failures_path      # csv of bonds that kept failing
+        self.checkpoint=checkpoint            # CheckpointStore or None
+        self.sync_state=sync_state            # SyncState or None, last written values are always recorded when set
+        self.delta=bool(delta) and sync_state is not None
+        self.refresh=set(refresh)             # bonds explicitly flagged to be fetched + written again in delta mode
+        self.delta_skipped=0                  # bonds not fetched in delta mode
+        self.unchanged_skipped=0              # rows not written because values did not change
+        self.save_rows=int(save_rows)         # merged rows buffered before one set-based db save
+        self.save_buffer=RateColumns()        # merged rows waiting for db save (db writer thread only)
+        self.saved_bonds=[]                   # bonds of buffered chunks, checkpointed once saved
+        self.bond_count=0                     # securities read from the (streamed) input
+        self.id_stats={}                      # duplicate / invalid IDs dropped before batching
+        self.bond_dates=None                  # backfill: bond -> AsOfDates to write, None = single AsOfDate
+        self.aborted=Event()                  # thread engine: run failed, batches already handed to workers are not sent
+
+        # Limits how many chunks are fetched/held in memory at once (securities are pulled lazily)
+        # (enough to keep either api busy at its concurrency ceiling, with one batch per chunk)
+        if max_chunks_in_flight:
+            self.max_chunks_in_flight=int(max_chunks_in_flight)
+        else:
+            self.max_chunks_in_flight=max(security_api.max_concurrency, coupon_api.max_concurrency)
+        self.log.debug(f'initialized fetch pipeline engine={self.engine} chunk_size={self.chunk_size} max_workers={self.max_workers} max_chunks_in_flight={self.max_chunks_in_flight}')
+
+
+
+    # Runs the whole fetch -> merge -> save stage for the given securities. Returns count of rows saved.
+    # Backfill: 'bond_dates' maps each bond to the AsOfDates it is written for, AsOfDate is then the label
+    # of the date range used for logs, checkpoint and failure list.
+    def run(self, securityIDList, AsOfDate, bond_dates=None):
+        self.bond_dates = normalize_bond_dates(bond_dates) if bond_dates is not None else None
+        securityIDList = unique_ids(self._counted(securityIDList), self.id_stats)
+        if self.checkpoint:
+            saved = self.checkpoint.completed('save')
+            if saved:
+                self.log.info(f"Skipping {len(saved)} bonds already saved for {AsOfDate} (checkpoint)")
+                securityIDList = (security for security in securityIDList if security not in saved)
+        if self.delta:
+            securityIDList = self._delta_filter(securityIDList, AsOfDate)
+        try:
+            if self.engine == 'async':
+                saved_count = self._run_async(securityIDList, AsOfDate)
+            else:
+                saved_count = self._run_threaded(securityIDList, AsOfDate)
+        finally:
+            if self.failures_path:
+                self.failures.save(self.failures_path, AsOfDate)
+        # Nothing but failures is not a completed run (the failure list alone does not abort below max_failed_bonds)
+        failed = len(self.failures.bonds())
+        if failed and failed >= self.bond_count - self.id_stats.get('duplicate', 0) - self.id_stats.get('invalid', 0):
+            self.log.error(f"All {failed} bonds failed for {AsOfDate}, run not completed")
+            raise SystemExit(-1)
+        return saved_count
+
+
+
+    def _run_threaded(self, securityIDList, AsOfDate):
+        chunks = enumerate(chunked(securityIDList, self.chunk_size))
+        pending = {}        # future -> (chunk_no, half)
+        halves = {}         # chunk_no -> {'security': [...], 'coupon': [...], 'remaining': batches not landed yet, 'chunk': securities}
+        writes = []         # futures of db writes
+        chunk_count = 0
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='api')
+        writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')    # single writer, db connection is not shared between threads
+        try:
+            exhausted = False
+            while True:
+                # Keep the window of in flight chunks full
+                while not exhausted and not self.aborted.is_set() and len(halves) < self.max_chunks_in_flight:
+                    next_chunk = next(chunks, None)
+                    if next_chunk is None:
+                        exhausted = True
+                        break
+                    chunk_no, chunk = next_chunk
+                    chunk_count += 1
+                    halves[chunk_no] = {'security': [], 'coupon': [], 'remaining': 0, 'chunk': chunk}
+                    for half, api in (('security', self.security_api), ('coupon', self.coupon_api)):
+                        cached, to_fetch = self._cached(api, chunk)
+                        halves[chunk_no][half] += cached
+                        for batch in api.batcher.split(to_fetch):
+                            future = executor.submit(self._fetch_checkpointed, api, batch)
+                            future.add_done_callback(self._abort_on_error)
+                            pending[future] = (chunk_no, half)
+                            halves[chunk_no]['remaining'] += 1
+
+                    # Everything came from checkpoint, nothing to wait for
+                    if halves[chunk_no]['remaining'] == 0:
+                        chunk_data = halves.pop(chunk_no)
+                        writes.append(writer.submit(self._write_chunk, chunk_no, chunk, chunk_data['security'], chunk_data['coupon'], AsOfDate))
+
+                if not pending:
+                    if exhausted:
+                        break
+                    continue
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk_no, half = pending.pop(future)
+                    halves[chunk_no][half] += future.result()
+                    halves[chunk_no]['remaining'] -= 1
+
+                    # Both halves landed -> hand the chunk over to db writer
+                    if halves[chunk_no]['remaining'] == 0:
+                        chunk_data = halves.pop(chunk_no)
+                        writes.append(writer.submit(self._write_chunk, chunk_no, chunk_data['chunk'], chunk_data['security'], chunk_data['coupon'], AsOfDate))
+
+                # Fail fast if db writer already failed
+                for write in writes:
+                    if write.done() and write.exception() is not None:
+                        write.result()
+
+            writes.append(writer.submit(self._flush_saves, AsOfDate))
+            saved_count = sum(write.result() for write in writes)
+            self._log_completed(AsOfDate, chunk_count, saved_count)
+            return saved_count
+
+        except BaseException as e:
+            self.aborted.set()
+            self.log.error(f"An error occured during pipelined fetch for {AsOfDate}: {str(e)} {repr(e)}")
+            executor.shutdown(wait=False, cancel_futures=True)
+            writer.shutdown(wait=False, cancel_futures=True)
+            raise SystemExit(-1)
+
+        finally:
+            executor.shutdown(wait=True)
+            writer.shutdown(wait=True)
+
+
+
+    # A failed batch fails the run, batches of other workers still waiting for a slot are not sent
+    def _abort_on_error(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.aborted.set()
+
+
+    def _counted(self, securityIDList):
+        for security in securityIDList:
+            self.bond_count += 1
+            yield security
+
+
+
+    # AsOfDates a bond is written for
+    def _dates(self, security, AsOfDate):
+        return self.bond_dates[security] if self.bond_dates is not None else (AsOfDate,)
+
+
+    # Delta mode: only bonds new for the AsOfDate(s), with expired cache entry or explicitly flagged go through
+    def _delta_filter(self, securityIDList, AsOfDate):
+        for chunk in chunked(securityIDList, self.chunk_size):
+            dates = {date for security in chunk for date in self._dates(security, AsOfDate)}
+            written = {date: self.sync_state.written(date, chunk) for date in dates}
+            fresh = self.security_api.cache.fresh(chunk) & self.coupon_api.cache.fresh(chunk)
+            for security in chunk:
+                if security in fresh and security not in self.refresh and all(security in written[date] for date in self._dates(security, AsOfDate)):
+                    self.delta_skipped += 1
+                    continue
+                yield security
+
+
+
+    # Records already in checkpoint / response cache for the chunk and the securities still to be fetched from the api
+    def _cached(self, api, chunk):
+        cached, to_fetch = [], chunk
+        if self.checkpoint:
+            cached, found = self.checkpoint.load(api.name, chunk)
+            to_fetch = [security for security in chunk if security not in found]
+        from_cache, to_fetch = api.cache.get_many(to_fetch)
+        return cached + from_cache, to_fetch
+
+
+    # Bonds already in flight on the api (another run/request) are not fetched again, their records are shared,
+    # bonds that failed for the run fetching them go on this run's failure list too
+    def _fetch_checkpointed(self, api, batch):
+        owned, shared = api.flights.claim(batch)
+        try:
+            records = self._fetch_batch(api, owned) if owned else []
+        except BaseException as e:
+            api.flights.fail(owned, e)
+            raise
+        api.flights.resolve(owned, records, self.failures.errors(api.name))
+        self._record_checkpoint(api, owned, records)
+        if shared:
+            metrics.count(f'{api.name}_api_shared', len(shared))
+        return records + self._shared_results(api, shared)
+
+
+    def _shared_results(self, api, shared):
+        records, failed = api.flights.results(shared)
+        for security, error in failed.items():
+            self.failures.add(api.name, security, error)
+        return records
+
+
+    def _record_checkpoint(self, api, batch, records):
+        if self.checkpoint:
+            failed = self.failures.bonds(api.name)      # failed bonds are fetched again on resume
+            self.checkpoint.record(api.name, [security for security in batch if security not in failed], records)
+
+
+
+    # Fetch one batch with retries. A batch rejected for its content (bad request, mapping error, too large) is
+    # split in half, down to single bonds which then go to the failure list, so one bad bond does not fail the run.
+    # A batch that keeps failing otherwise goes to the failure list as a whole, auth / not found errors end the run.
+    def _fetch_batch(self, api, batch, attempts=None):
+        attempts = attempts or self.retry_policy.max_attempts
+        for attempt in range(attempts):
+            try:
+                with profiler.stage(f'{api.name}_api'):
+                    data = api.fetch_all(batch, 'BOND', self.aborted)
+                return data if isinstance(data, list) else []
+            except APIRequestError as e:
+                error = e
+                delay = self._retry_delay(api, batch, e, attempt, attempts)
+                if delay is None:
+                    break
+                sleep(delay)
+
+        return [record for half in self._give_up(api, batch, error) for record in self._fetch_batch(api, half, self.split_attempts)]
+
+
+    # Retry / split decisions shared by both engines (_fetch_batch, _fetch_batch_async)
+    # Seconds to wait before the next attempt of a failed batch, None when it is not retried
+    def _retry_delay(self, api, batch, error, attempt, attempts):
+        if not self.retry_policy.is_retryable(error) or attempt + 1 == attempts:
+            return None
+        delay = self.retry_policy.delay(attempt, error.retry_after)
+        self.log.warning(f"{api.name} api batch of {len(batch)} failed (attempt {attempt + 1}/{attempts}), retrying in {delay:.1f}s")
+        metrics.count(f'{api.name}_api_retries')
+        return delay
+
+
+    # Batch out of attempts: raises fatal errors, else returns the halves to fetch next ([] = bonds went to the failure list)
+    def _give_up(self, api, batch, error):
+        if self.retry_policy.is_fatal(error):
+            raise error
+        if len(batch) == 1 or not self.retry_policy.should_split(error):
+            for security in batch:
+                self.failures.add(api.name, security, error)
+            return []
+        metrics.count(f'{api.name}_api_splits')
+        middle = len(batch) // 2
+        return [batch[:middle], batch[middle:]]
+
+
+
+
+    def _run_async(self, securityIDList, AsOfDate):
+        from async_engine import AsyncAPIEngine     # aiohttp is only loaded for engine=async
+        engine = AsyncAPIEngine([self.security_api, self.coupon_api], self.log)
+        writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')    # db calls are blocking, keep them off the event loop
+        try:
+            saved_count, chunk_count = engine.run(self._pipeline_async, engine, writer, securityIDList, AsOfDate)
+            self._log_completed(AsOfDate, chunk_count, saved_count)
+            return saved_count
+
+        except BaseException as e:
+            self.log.error(f"An error occured during pipelined fetch for {AsOfDate}: {str(e)} {repr(e)}")
+            writer.shutdown(wait=False, cancel_futures=True)
+            raise SystemExit(-1)
+
+        finally:
+            writer.shutdown(wait=True)
+
+
+    async def _pipeline_async(self, engine, writer, securityIDList, AsOfDate):
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(self.max_chunks_in_flight)
+
+        async def fetch_batch(api, batch):
+            owned, shared = api.flights.claim(batch)
+            try:
+                records = await self._fetch_batch_async(engine, api, owned) if owned else []
+            except BaseException as e:
+                api.flights.fail(owned, e)
+                raise
+            api.flights.resolve(owned, records, self.failures.errors(api.name))
+            self._record_checkpoint(api, owned, records)
+            if shared:
+                metrics.count(f'{api.name}_api_shared', len(shared))
+                await asyncio.gather(*(asyncio.wrap_future(future) for future in shared.values()), return_exceptions=True)
+            return records + self._shared_results(api, shared)
+
+        async def fetch_half(api, chunk):
+            cached, to_fetch = self._cached(api, chunk)
+            results = await asyncio.gather(*(fetch_batch(api, batch) for batch in api.batcher.split(to_fetch)))
+            return cached + [record for result in results for record in result]
+
+        async def process(chunk_no, chunk):
+            try:
+                # Both halves of the chunk in flight together, then merge + save on the db writer thread
+                security_data, coupon_data = await asyncio.gather(
+                    fetch_half(self.security_api, chunk),
+                    fetch_half(self.coupon_api, chunk)
+                )
+                return await loop.run_in_executor(writer, self._write_chunk, chunk_no, chunk, security_data, coupon_data, AsOfDate)
+            finally:
+                in_flight.release()
+
+        # First failed chunk (fatal api error, db save error) ends the run: no more chunks are started, the rest are cancelled
+        tasks, errors = [], []
+        def chunk_done(task):
+            if not task.cancelled() and task.exception() is not None:
+                errors.append(task.exception())
+
+        for chunk_no, chunk in enumerate(chunked(securityIDList, self.chunk_size)):
+            await in_flight.acquire()
+            if errors:
+                break
+            task = asyncio.create_task(process(chunk_no, chunk))
+            task.add_done_callback(chunk_done)
+            tasks.append(task)
+
+        if tasks and not errors:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        if errors:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise errors[0]
+        flushed = await loop.run_in_executor(writer, self._flush_saves, AsOfDate)
+        return sum(task.result() for task in tasks) + flushed, len(tasks)
+
+
+    async def _fetch_batch_async(self, engine, api, batch, attempts=None):
+        attempts = attempts or self.retry_policy.max_attempts
+        for attempt in range(attempts):
+            try:
+                data = await engine.fetch(api, batch, 'BOND')
+                return data if isinstance(data, list) else []
+            except APIRequestError as e:
+                error = e
+                delay = self._retry_delay(api, batch, e, attempt, attempts)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+
+        halves = await asyncio.gather(*(self._fetch_batch_async(engine, api, half, self.split_attempts) for half in self._give_up(api, batch, error)))
+        return [record for half in halves for record in half]
+
+
+
+    def _log_completed(self, AsOfDate, chunk_count, saved_count):
+        self.log.info(f"Fetch pipeline completed for {AsOfDate}: {self.bond_count} securities, {chunk_count} chunks, {saved_count} rows saved, {len(self.failures)} bonds failed")
+        for api in (self.security_api, self.coupon_api):
+            self.log.info(api.batcher.summary())
+            self.log.info(api.concurrency.summary())
+            self.log.info(api.cache.summary())
+            metrics.count(f'{api.name}_cache_hits', api.cache.hits)
+            metrics.count(f'{api.name}_cache_revalidated', api.cache.revalidated)
+            metrics.count(f'{api.name}_api_concurrency_decreases', api.concurrency.decreases)
+        metrics.count('bonds', self.bond_count)
+        metrics.count('bonds_failed', len(self.failures))
+        if self.id_stats.get('duplicate') or self.id_stats.get('invalid'):
+            self.log.info(f"Bond IDs for {AsOfDate}: {self.id_stats['duplicate']} duplicates and {self.id_stats['invalid']} empty IDs not fetched again")
+            metrics.count('bonds_duplicate', self.id_stats['duplicate'])
+            metrics.count('bonds_invalid', self.id_stats['invalid'])
+        if self.delta:
+            self.log.info(f"Delta sync for {AsOfDate}: {self.delta_skipped} bonds not fetched, {self.unchanged_skipped} unchanged rows not written")
+
+
+
+    # Merge both halves of a chunk and buffer them for db save, returns rows saved if the buffer got flushed
+    def _write_chunk(self, chunk_no, chunk, security_data, coupon_data, AsOfDate):
+        failed = self.failures.bonds()
+        with metrics.timer('merge'):
+            merged = self._merge_chunk(chunk, security_data, coupon_data, AsOfDate, failed)
+        if len(merged) == 0:
+            self.log.debug(f"No security data to save in chunk {chunk_no} for {AsOfDate}")
+        else:
+            self.save_buffer.extend(merged)
+        self.saved_bonds += [security for security in chunk if security not in failed]
+
+        if len(self.save_buffer) >= self.save_rows:
+            return self._flush_saves(AsOfDate)
+        return 0
+
+
+    # Security + coupon records of a chunk joined into rows of its AsOfDate(s), unchanged rows dropped in delta mode
+    def _merge_chunk(self, chunk, security_data, coupon_data, AsOfDate, failed):
+        if self.bond_dates is None:
+            merged = merge_records(security_data, resolve_all(coupon_data, AsOfDate), AsOfDate, exclude=failed)
+        else:
+            # Backfill: the chunk's records resolved once per AsOfDate, each date only gets the bonds due on it
+            by_date = {}
+            for security in chunk:
+                for date in self.bond_dates[security]:
+                    by_date.setdefault(date, set()).add(security)
+            merged = RateColumns()
+            for date, bonds in sorted(by_date.items()):
+                merged.extend(merge_records(
+                    [record for record in security_data if record[0] in bonds],
+                    resolve_all([record for record in coupon_data if record[0] in bonds], date),
+                    date, exclude=failed
+                ))
+        if self.delta:
+            merged = self._changed_rows(merged)
+        return merged
+
+
+    # Save buffered rows into database with one set-based write
+    def _flush_saves(self, AsOfDate):
+        saved_count = 0
+        if len(self.save_buffer):
+            saved_count = self.db.save_data(self.save_buffer)
+            if self.sync_state:
+                self.sync_state.record(self.save_buffer.rows())
+        if self.checkpoint and self.saved_bonds:
+            self.checkpoint.record_saved(self.saved_bonds)
+        self.save_buffer, self.saved_bonds = RateColumns(), []
+        return saved_count
+
+
+    # Drop rows whose (rate, EffectiveDate) equals what was last written for the bond + AsOfDate
+    def _changed_rows(self, merged):
+        bonds_by_date = {}
+        for bondId, AsOfDate in zip(merged.bondId, merged.AsOfDate):
+            bonds_by_date.setdefault(AsOfDate, []).append(bondId)
+        written = {AsOfDate: self.sync_state.written(AsOfDate, bonds) for AsOfDate, bonds in bonds_by_date.items()}
+        if not any(written.values()):
+            return merged
+        changed = [
+            bondId in self.refresh or written[AsOfDate].get(bondId) != row_key(rate, EffectiveDate)
+            for bondId, AsOfDate, rate, EffectiveDate in merged.rows()
+        ]
+        self.unchanged_skipped += changed.count(False)
+        return merged.filter(changed)
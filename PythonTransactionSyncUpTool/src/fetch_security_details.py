@@ -1,105 +1,47 @@
-import json
-import math
-import requests
-import pandas as pd
-from datetime import date, datetime
-from requests.auth import HTTPBasicAuth
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from logging import getLogger, CRITICAL
+from api_base import APIBase
+from json_parser import scalar_fields
 
 
-pd.set_option('Display.max_rows', None)
+class SecurityAPI(APIBase):
 
+    name = 'security'
+    fields = ('couponFix', 'couponFloat', 'cpnType', 'bond', 'BOND')      # only fields used by the mapping
 
-class SecurityAPI:
-
-    def __init__(self, url, token, user, pwd, log):
-        self.log=log
-        self.url=url
-        self.token=token
-        self.user=user
-        self.pwd=pwd
-        self.request_id=12345678910
-        self.log.debug(f'initialized security api {user}@{url}')
-
-
-
-    # Batch processing + Concurrency (parallel execution)
-    def fetch_security_details_batch(self, securityIDList):
-        all_securityIDs = []
-        batch_size = 50
-        securityID_batch_list = [securityIDList[i:i + batch_size] for i in range(0, len(securityIDList), batch_size)]
-
-        # Fetch security details for each batch concurrently
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = [
-                executor.submit(self.fetch_Security_details_all, securities, 'BOND')
-                for securities in securityID_batch_list
-            ]
-
-            for future in as_completed(futures):
-                try:
-                    t=future.result()
-                    if isinstance(t, list):
-                        all_securityIDs += t
-                except Exception as e:
-                    self.log.error(f"An error occured during concurrent execution of security API: {str(e)} %s", repr(e))
-                    raise SystemExit(-1)
-                
-        return all_securityIDs
-    
 
     # Fetch security details for a list of securities
     def fetch_security_details_all(self, securityList:list, assetClass='BOND'):
-        security_data = []
-        securityIDList = ""
-        for security in securityList:
-            if isinstance(security, str):
-                securityIDList += security + ","
-
-        headers = {
-            'Content-Type':'application/json',
-            'Request-ID':str(self.request_id),
-            'Origin-Timestamp':datetime.now().isoformat(timespec='milliseconds') + 'Z',
-            'API-Key':self.token
-        }
-
-        params = {
-            'bondId':securityIDList,
-            'bondIdType':assetClass
-        }
+        return self.fetch_all(securityList, assetClass)
 
-        try:
-            response = requests.get(
-                self.url,
-                headers=headers,
-                params=params,
-                auth=HTTPBasicAuth(self.user, self.pwd)
-            )
-            response.raise_for_status()
 
-        except requests.exceptions.RequestException as e:
-            self.log.error(f"Request error on {self.url} for {securityIDList}: {str(e)} %s", repr(e))
-            raise SystemExit(-1)
-        
-        try:
-            data = response.json
-            security_details = data.get('bondByAssetId', {})
-            for security_key, security_values in security_details.items():
-                for security_record_key, security_record_details in security_values.items():
-                    if security_record_key=='bondId' or type(security_record_details) is str:
-                        continue
-                    bond = security_record_details.get('BOND')
-                    fixRate = security_record_details.get('couponFix', 0)
-                    floatRate = security_record_details.get('couponFloat', 0)
-                    cpnType = security_record_details.get('cpnType', 'F')
-                    rate = fixRate if cpnType=='F' else floatRate
-                    security_data.append({
-                        "bondId": bond,
-                        "rate": rate
-                    })
-            return security_data    # List of tuples
-
-        except Exception as e:
-            self.log.error(f"Mapping error for {securityIDList}: {str(e)} %s")
-            raise SystemExit(-1) 
\ No newline at end of file
+    # Map security API response into [(bondId, rate)]
+    def parse(self, data, securityIDList):
+        security_data = []
+        security_details = data.get('bondByAssetId', {})
+        for security_key, security_values in security_details.items():
+            for security_record_key, security_record_details in security_values.items():
+                if security_record_key=='bondId' or type(security_record_details) is not dict:
+                    continue
+                if not any(field in security_record_details for field in self.fields):     # Ex- ratings, as parse_stream never sees them
+                    continue
+                security_data.append(self.security_record(security_record_details, security_key))
+        return security_data    # List of tuples
+
+
+    # Same mapping straight from the raw response bytes (json_parser=stream)
+    def parse_stream(self, content, securityIDList):
+        records = {}
+        for path, field, value in scalar_fields(content, 'bondByAssetId', self.fields):
+            if len(path) == 2:      # (asset, record key)
+                records.setdefault(path, {})[field] = value
+        return [self.security_record(record, path[0]) for path, record in records.items()]
+
+
+    # Records without a bond field are keyed by their asset key (bonds are requested by ID, so it is the bondId)
+    @staticmethod
+    def security_record(record, security_key=None):
+        bond = record.get('bond') or record.get('BOND') or security_key
+        fixRate = record.get('couponFix', 0)
+        floatRate = record.get('couponFloat', 0)
+        cpnType = record.get('cpnType', 'F')
+        rate = fixRate if cpnType=='F' else floatRate
+        return (bond, rate)
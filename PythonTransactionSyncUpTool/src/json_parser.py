@@ -0,0 +1,66 @@
+# Pluggable json parser backend for api responses (json_parser in [SECURITY_API]/[COUPON_API]).
+#   json   - standard library, builds the full object tree
+#   orjson - same tree but much faster (optional package)
+#   stream - incremental event driven parsing with ijson (optional package), works on the raw response bytes
+#            and only extracts the fields the api needs, the full tree is never built
+#   auto   - orjson when installed, else json
+
+import json
+from array import array
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+backends = ('auto', 'json', 'orjson', 'stream')
+
+
+def select_backend(name, log):
+    name = str(name or 'auto').lower()
+    if name not in backends:
+        raise ValueError(f"Unknown json_parser '{name}', expected one of {', '.join(backends)}")
+    if name == 'auto':
+        return 'orjson' if orjson is not None else 'json'
+    if name == 'orjson' and orjson is None:
+        log.warning("json_parser=orjson but orjson is not installed, using json")
+        return 'json'
+    if name == 'stream' and ijson is None:
+        log.warning("json_parser=stream but ijson is not installed, using json")
+        return 'json'
+    return name
+
+
+# json.dumps 'default' for cached / checkpointed records: compact arrays (coupon schedules) as lists, anything else as str
+def to_json(value):
+    return value.tolist() if isinstance(value, array) else str(value)
+
+
+def loads(backend, content):
+    if backend == 'orjson':
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+# Streams scalar values below 'root' whose key is in 'fields' -> (path between root and key, key, value).
+# Ex- for {"bondByAssetId": {"A1": {"CASH": {"couponFix": 4.5}}}} yields (('A1', 'CASH'), 'couponFix', 4.5)
+# The path is kept from the map keys themselves (not ijson's dotted prefix), so keys holding a dot (Ex- BRK.B) stay whole.
+def scalar_fields(content, root, fields):
+    path = []       # key of every open container down to the current value, 'item' inside arrays
+    for event, value in ijson.basic_parse(content, use_float=True):
+        if event == 'map_key':
+            path[-1] = value
+        elif event == 'start_map':
+            path.append(None)
+        elif event == 'start_array':
+            path.append('item')
+        elif event in ('end_map', 'end_array'):
+            path.pop()
+        elif path and path[0] == root and path[-1] in fields:
+            yield tuple(path[1:-1]), path[-1], value
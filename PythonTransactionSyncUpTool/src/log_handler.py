@@ -3,88 +3,267 @@ from sys import stdout
 from os import makedirs, getlogin
 from os.path import dirname
 from datetime import datetime
-from logging import DEBUG, ERROR, Handler, FileHandler, StreamHandler, Handler, Filter, Formatter, basicConfig, getLogger
+from collections import deque
+from queue import SimpleQueue
+from threading import Lock
+from atexit import register
+from logging import DEBUG, WARNING, ERROR, Handler, FileHandler, StreamHandler, Filter, Formatter, basicConfig, getLogger
+from logging.handlers import QueueHandler, QueueListener
 
 
-def init_log():
-    
-    # Initializes logging with console + memory handler (for replay).
-    format_spec = '%(asctime)s - %(levelname)-8s - %(login)s@%(hostname)s - %(message)s'
+# Logging pipeline: in queue mode (default) calling threads only put records on a queue, one background listener
+# thread formats them and writes console + files, so api worker threads never wait on log I/O.
+# Records are kept in a bounded ring buffer until the dated log file is configured (then replayed into it),
+# very large messages (row dumps, bondId lists) are truncated / sampled before they are queued.
+FORMAT_SPEC = '%(asctime)s - %(levelname)-8s - %(login)s@%(hostname)s - %(message)s'
 
-    memory_handler = MemoryHandler()
-    console_handler = StreamHandler(stdout)
-    console_handler.setFormatter(Formatter(format_spec))
-    memory_handler.setFormatter(Formatter(format_spec))
 
-    basicConfig(level=DEBUG, format=format_spec, handlers=[memory_handler, console_handler])
+def init_log(queue=True, buffer_size=10000, max_message_length=20000, large_message_sample=1, session_file=True):
+
+    # Initializes logging with console + memory handler (for replay).
+    # session_file=False leaves last-session.log alone (worker processes, it holds the main process' session)
+    memory_handler = MemoryHandler(buffer_size)
+    console_handler = StreamHandler(stdout)
+    handlers = [memory_handler, console_handler]
 
     log = getLogger("PythonConsoleApp")
+    session_error = None
+    if session_file:
+        try:
+            session_handler = FileHandler(filename="last-session.log", mode="w", encoding="utf-8")
+            session_handler.addFilter(Filter(log.name))     # app records only, as the dated log file
+            handlers.append(session_handler)
+        except Exception as e:
+            session_error = e
+
+    pipeline = LogPipeline(log, handlers, memory_handler, queue, LargeMessageFilter(max_length=max_message_length, sample=large_message_sample))
+    # force: a forked worker process inherits root handlers of the parent whose listener thread does not exist here
+    basicConfig(level=DEBUG, handlers=pipeline.front_handlers(), force=True)
+
     log.format_events = memory_handler.format_events
-    log.addFilter(UserHostFilter())
     log.contains_error = memory_handler.contains_error
+    log.flush = pipeline.flush
 
-    try:
-        log.addHandler(FileHandler(filename="last-session.log", mode="w", encoding="utf-8"))
-    except Exception as e:
-        log.warning(f"Failed to attach log file in app dir. {e}")
-
-    # Attach dynamic config function
-    log.config = lambda path, form, level: _config_log(log, path, form, level, memory_handler)
+    # Attach dynamic config function, called with the [log] section of config.ini
+    log.config = pipeline.config
+    log.roll = pipeline.roll
 
-    log.debug("Initialized logging")
+    if session_error:
+        log.warning(f"Failed to attach log file in app dir. {session_error}")
+    log.debug(f"Initialized logging ({'queue' if pipeline.listener else 'synchronous'} mode)")
     return log
 
 
 
-def _config_log(log, path, form, level, memory_handler):
-    
-    #Configure log file location and replay memory logs to file.
-    try:
-        # Replace {date} placeholder with today's date
-        path = path.format(date=datetime.today().strftime("%Y-%m-%d"))
-        log.debug(f"Configuring logging to '{path}'")
+class LogPipeline:
+
+    def __init__(self, log, handlers, memory_handler, queue, message_filter):
+        self.log=log
+        self.handlers=handlers                  # handlers doing the formatting / writing
+        self.memory_handler=memory_handler
+        self.message_filter=message_filter
+        self.host_filter=UserHostFilter()
+        self.lock=Lock()
+        self.listener=None
+        self.queue_handler=None
+        self.running=False                      # listener thread started
+        self.path_template=None                 # [log] path with {date}, set by config
+        self.file_handler=None                  # dated log file handler
+        self.file_path=None
+        for handler in handlers:
+            handler.setFormatter(Formatter(FORMAT_SPEC))
+        if str(queue).lower() in ('true', '1', 'yes'):
+            self._start_queue()
+        register(self.stop)
+
+
+    # Handlers attached to the root logger: the queue handler, or the real handlers in synchronous mode
+    def front_handlers(self):
+        front = [self.queue_handler] if self.queue_handler else self.handlers
+        for handler in front:
+            handler.addFilter(self.host_filter)
+            handler.addFilter(self.message_filter)
+        return front
+
+
+    def _start_queue(self):
+        self.queue_handler = QueueHandler(SimpleQueue())
+        self.queue_handler.setFormatter(Formatter('%(message)s'))     # merges args + exception text only, full format runs on the listener
+        self.listener = QueueListener(self.queue_handler.queue, *self.handlers, respect_handler_level=True)
+        self.listener.start()
+        self.running = True
+
 
-        makedirs(dirname(path), exist_ok=True)
-        file_handler = FileHandler(path, encoding="utf-8")
-        file_handler.setFormatter(Formatter(form))
-        log.addHandler(file_handler)
-        log.setLevel(getattr(__import__("logging"), level.upper(), DEBUG))
+    # Drains the queue (all records logged so far are written) and stops the listener thread
+    def stop(self):
+        with self.lock:
+            if self.running:
+                self.listener.stop()
+                self.running = False
 
-        # Ensure all handlers share the same format
-        for h in log.handlers:
-            h.setFormatter(Formatter(form))
 
-        # Replay past log records into file
-        memory_handler.replay(file_handler)
+    def flush(self):
+        with self.lock:
+            if self.running:
+                self.listener.stop()
+                self.listener.start()
+        for handler in self.handlers:
+            handler.flush()
 
-    except Exception as e:
-        log.error(f"Failed to configure log file {path}. {e}")
+
+    # Configure log file location and replay memory logs to file.
+    # queue / max_message_length / large_message_sample can be set in [log] too, ex- queue=False for synchronous logging
+    def config(self, path, form=FORMAT_SPEC, level='debug', queue=None, max_message_length=None, large_message_sample=None):
+        if max_message_length is not None:
+            self.message_filter.max_length = int(max_message_length)
+        if large_message_sample is not None:
+            self.message_filter.sample = max(1, int(large_message_sample))
+        if queue is not None and str(queue).lower() not in ('true', '1', 'yes') and self.queue_handler:
+            self._use_synchronous()
+
+        try:
+            # Replace {date} placeholder with today's date
+            self.path_template = path
+            path = path.format(date=datetime.today().strftime("%Y-%m-%d"))
+            self.log.debug(f"Configuring logging to '{path}'")
+
+            makedirs(dirname(path), exist_ok=True)
+            file_handler = FileHandler(path, encoding="utf-8")
+            file_handler.addFilter(Filter(self.log.name))
+            self.file_handler, self.file_path = file_handler, path
+            self.log.setLevel(getattr(__import__("logging"), level.upper(), DEBUG))
+
+            # Listener is paused while handlers change, so no record is written half way through
+            with self.lock:
+                if self.running:
+                    self.listener.stop()
+                self.handlers.append(file_handler)
+                # Ensure all handlers share the same format
+                for h in self.handlers:
+                    h.setFormatter(Formatter(form))
+                # Replay past log records into file, buffer is emptied after
+                dropped = self.memory_handler.replay(file_handler)
+                if self.listener:
+                    self.listener.handlers = tuple(self.handlers)
+                    if self.running:
+                        self.listener.start()
+                else:
+                    file_handler.addFilter(self.host_filter)
+                    file_handler.addFilter(self.message_filter)
+                    getLogger().addHandler(file_handler)
+            if dropped:
+                self.log.warning(f"{dropped} earlier log records were dropped from the memory buffer before '{path}' was configured")
+
+        except Exception as e:
+            self.log.error(f"Failed to configure log file {path}. {e}")
+
+
+    # Long running process (service mode): moves to the log file of today's date once the date changed,
+    # so every job logs into the dated folder its failure list and run summary go to
+    def roll(self):
+        if self.file_handler is None:
+            return
+        path = self.path_template.format(date=datetime.today().strftime("%Y-%m-%d"))
+        if path == self.file_path:
+            return
+        try:
+            makedirs(dirname(path), exist_ok=True)
+            file_handler = FileHandler(path, encoding="utf-8")
+        except Exception as e:
+            self.log.error(f"Failed to roll log file to {path}. {e}")
+            return
+        old_handler = self.file_handler
+        for log_filter in old_handler.filters:
+            file_handler.addFilter(log_filter)
+        file_handler.setFormatter(old_handler.formatter)
+        file_handler.setLevel(old_handler.level)
+
+        self.log.info(f"Log continues in '{path}'")
+        with self.lock:
+            if self.running:
+                self.listener.stop()
+            self.handlers[self.handlers.index(old_handler)] = file_handler
+            if self.listener:
+                self.listener.handlers = tuple(self.handlers)
+                if self.running:
+                    self.listener.start()
+            else:
+                getLogger().removeHandler(old_handler)
+                getLogger().addHandler(file_handler)
+            self.file_handler, self.file_path = file_handler, path
+        old_handler.close()
+
+
+    def _use_synchronous(self):
+        self.stop()
+        root = getLogger()
+        root.removeHandler(self.queue_handler)
+        self.queue_handler = None
+        self.listener = None
+        for handler in self.front_handlers():
+            root.addHandler(handler)
+        self.log.debug("Logging switched to synchronous mode")
 
 
 
 class MemoryHandler(Handler):
-    # Stores log records in memory until a file is configured.
-    def __init__(self) -> None:
-        self.log_records = []
+    # Stores the latest log records in memory (bounded ring buffer) until a file is configured.
+    def __init__(self, capacity=10000) -> None:
+        self.log_records = deque(maxlen=int(capacity) or None)
+        self.dropped = 0                # oldest records pushed out of the buffer
+        self.error_sources = set()      # filename:funcName of ERROR records, kept after the buffer is flushed
         super().__init__()
 
     def emit(self, record):
+        if len(self.log_records) == self.log_records.maxlen:
+            self.dropped += 1
         self.log_records.append(record)
+        if record.levelno >= ERROR:
+            self.error_sources.add(f"{record.filename}:{record.funcName}")
 
     def format_events(self):
         return '\n'.join([self.format(record) for record in self.log_records])
 
     def contains_error(self, search_string=None):
-        def filter_func(record):
-            return (
-                record.levelno >= ERROR
-                and (search_string is None or search_string in f"{record.filename}:{record.funcName}")
-            )
-        return any(filter(filter_func, self.log_records))
+        return any(search_string is None or search_string in source for source in self.error_sources)
 
+    # Writes buffered records into other handler and empties the buffer, returns count of records dropped before
     def replay(self, other: Handler):
         for r in self.log_records:
-            other.emit(r)
+            if other.filter(r):
+                other.emit(r)
+        dropped = self.dropped
+        self.log_records.clear()
+        self.dropped = 0
+        return dropped
+
+
+
+class LargeMessageFilter(Filter):
+    # Truncates messages longer than max_length, with sample > 1 only every n-th large DEBUG/INFO message is kept
+    def __init__(self, max_length=20000, sample=1):
+        super().__init__()
+        self.max_length = int(max_length)
+        self.sample = max(1, int(sample))
+        self.large = 0
+        self.lock = Lock()
+
+    def filter(self, record):
+        if self.max_length <= 0:
+            return True
+        message = record.getMessage()
+        if record.args:
+            record.msg, record.args = message, None     # merged once here, not again by every handler
+        if len(message) <= self.max_length:
+            return True
+        if record.levelno < WARNING and self.sample > 1:
+            with self.lock:
+                self.large += 1
+                if self.large % self.sample != 1:
+                    return False
+        record.msg = f"{message[:self.max_length]}... [{len(message) - self.max_length} chars truncated]"
+        record.args = None
+        return True
 
 
 
@@ -99,4 +278,4 @@ class UserHostFilter(Filter):
     def filter(self, record):
         record.hostname = UserHostFilter.hostname
         record.login = UserHostFilter.login
-        return True
\ No newline at end of file
+        return True
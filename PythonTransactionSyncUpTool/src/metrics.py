@@ -0,0 +1,122 @@
+# Run instrumentation: timers + counters recorded by every stage (db read, api batches, merge, db save, rerate flag).
+# One process wide 'metrics' instance (thread safe), summarized at the end of a run into
+#   - run_summary_{AsOfDate}.json next to the dated log (stage durations with p50/p95/p99, counters)
+#   - optional Prometheus textfile ([METRICS] prometheus_path, for node_exporter textfile collector)
+# Timer names: db_read, {api}_api, merge, db_save, db_flag, fetch, total. Counters: {api}_api_bytes, {api}_api_retries, ...
+
+import json
+from math import ceil
+from time import perf_counter
+from datetime import datetime
+from contextlib import contextmanager
+from os import makedirs, replace
+from os.path import dirname
+from threading import Lock
+from profiling import profiler
+
+
+# Nearest-rank percentile of sorted values
+def percentile(values, p):
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, ceil(p / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+
+class Metrics:
+
+    quantiles = (50, 95, 99)
+
+    def __init__(self):
+        self.lock=Lock()
+        self.timings={}         # name -> [seconds, ...]
+        self.counters={}        # name -> number
+        self.started=datetime.now()
+
+
+    # Starts over for the next job of a long running process (service mode)
+    def reset(self):
+        with self.lock:
+            self.timings={}
+            self.counters={}
+            self.started=datetime.now()
+
+
+    # Also a profiled stage when the run is profiled (--profile)
+    @contextmanager
+    def timer(self, name):
+        start = perf_counter()
+        try:
+            with profiler.stage(name):
+                yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+
+    def observe(self, name, seconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    # {'timings': {name: {count, total, p50, p95, p99, max}}, 'counters': {name: value}}
+    def summary(self):
+        with self.lock:
+            timings = {name: sorted(values) for name, values in self.timings.items()}
+            counters = dict(self.counters)
+        stats = {}
+        for name, values in timings.items():
+            stats[name] = {'count': len(values), 'total': round(sum(values), 6)}
+            for q in self.quantiles:
+                stats[name][f'p{q}'] = round(percentile(values, q), 6)
+            stats[name]['max'] = round(values[-1], 6)
+        return {'timings': stats, 'counters': counters}
+
+
+    # Logs one line per timer, ex- "security_api: 120 x, total 35.20s, p50 0.250s, p95 0.610s, p99 1.020s"
+    def log_summary(self, log):
+        summary = self.summary()
+        for name, stat in sorted(summary['timings'].items()):
+            log.info(f"{name}: {stat['count']} x, total {stat['total']:.2f}s, " + ", ".join(f"p{q} {stat[f'p{q}']:.3f}s" for q in self.quantiles))
+        if summary['counters']:
+            log.info("counters: " + ", ".join(f"{name}={value}" for name, value in sorted(summary['counters'].items())))
+
+
+    def write_json(self, path, **run):
+        document = {'run': dict(run, started=self.started.isoformat(timespec='seconds'), finished=datetime.now().isoformat(timespec='seconds'))}
+        document.update(self.summary())
+        self._write(path, json.dumps(document, indent=2, default=str))
+
+
+    # Prometheus text exposition format: timers as summaries with quantiles, counters as *_total
+    def write_prometheus(self, path, prefix='rerate', **labels):
+        summary = self.summary()
+        base = ",".join(f'{key}="{value}"' for key, value in labels.items())
+        lines = [f"# TYPE {prefix}_duration_seconds summary"]
+        for name, stat in sorted(summary['timings'].items()):
+            label = f'{base},stage="{name}"' if base else f'stage="{name}"'
+            for q in self.quantiles:
+                lines.append(f'{prefix}_duration_seconds{{{label},quantile="{q / 100}"}} {stat[f"p{q}"]}')
+            lines.append(f'{prefix}_duration_seconds_sum{{{label}}} {stat["total"]}')
+            lines.append(f'{prefix}_duration_seconds_count{{{label}}} {stat["count"]}')
+        for name, value in sorted(summary['counters'].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total{{{base}}} {value}")
+        self._write(path, "\n".join(lines) + "\n")
+
+
+    # Written to a temp file and renamed, readers never see a half written file
+    def _write(self, path, text):
+        makedirs(dirname(path) or '.', exist_ok=True)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as file:
+            file.write(text)
+        replace(f"{path}.tmp", path)
+
+
+
+metrics = Metrics()
@@ -0,0 +1,128 @@
+# Opt-in profiling (--profile): CPU profile per pipeline stage + tracemalloc allocation report.
+# Stages are the metrics timers (merge, db_save, db_flag, fetch) and the api calls ({api}_api) / response parsing
+# ({api}_parse). cProfile only sees the thread it is enabled on, so every worker thread running a stage gets its
+# own profile, all profiles of a stage are merged when written. Times are wall clock: time waiting on the network
+# or db shows up in socket / pyodbc calls, parsing and merging in their own functions.
+# Nested stages (parse inside an api call) are profiled separately, the outer profile is paused meanwhile.
+# engine=async: requests interleave on the event loop, so there is no {api}_api stage, they are part of 'fetch'.
+# Files written into the dated log folder:
+#   profile_{AsOfDate}_{stage}.prof  pstats file of the stage (Ex- python -m pstats, snakeviz)
+#   profile_{AsOfDate}.txt           top functions per stage (cumulative time)
+#   allocations_{AsOfDate}.txt       peak memory + top allocation sites grown during the run
+
+import cProfile
+import tracemalloc
+from os import makedirs
+from os.path import join
+from threading import Lock, local
+from contextlib import contextmanager
+
+
+class Profiler:
+
+    def __init__(self):
+        self.enabled=False
+        self.lock=Lock()
+        self.local=local()          # per thread: stack of active profiles + profiles of the current run
+        self.run=0                  # run number, thread locals of an earlier run are not reused
+        self.profiles={}            # stage -> [cProfile.Profile, one per thread]
+        self.skipped=0              # stage calls not profiled (another profiler active on the thread)
+        self.snapshot=None
+
+
+    # Returns False when a profiled run is already going on (service mode with concurrent jobs)
+    def start(self, frames=5):
+        with self.lock:
+            if self.enabled:
+                return False
+            self.run += 1
+            self.profiles = {}
+            self.skipped = 0
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(int(frames))
+            tracemalloc.reset_peak()
+            self.snapshot = tracemalloc.take_snapshot()
+            self.enabled = True
+            return True
+
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        if getattr(self.local, 'run', None) != self.run:
+            self.local.run, self.local.stack, self.local.profiles = self.run, [], {}
+        stack = self.local.stack
+        profile = self.local.profiles.get(name)
+        if profile is None:
+            profile = self.local.profiles[name] = cProfile.Profile()
+            with self.lock:
+                self.profiles.setdefault(name, []).append(profile)
+        if profile in stack:        # same stage again further down the call, already measured
+            yield
+            return
+
+        if stack:
+            stack[-1].disable()
+        try:
+            profile.enable()
+        except ValueError:          # python 3.12+: one cProfile at a time per process
+            self.skipped += 1
+            if stack:
+                stack[-1].enable()
+            yield
+            return
+        stack.append(profile)
+        try:
+            yield
+        finally:
+            profile.disable()
+            stack.pop()
+            if stack:
+                stack[-1].enable()
+
+
+    # Writes the per stage profiles + allocation report into 'directory', returns the report paths
+    def stop(self, directory, label, top=30):
+        import io
+        import pstats
+
+        with self.lock:
+            if not self.enabled:
+                return []
+            self.enabled = False
+            profiles, snapshot = self.profiles, self.snapshot
+        current = tracemalloc.take_snapshot()
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        makedirs(directory, exist_ok=True)
+        report = io.StringIO()
+        for name, stage_profiles in sorted(profiles.items()):
+            stats = pstats.Stats(*stage_profiles, stream=report)
+            stats.dump_stats(join(directory, f"profile_{label}_{name}.prof"))
+            report.write(f"\n===== {name} ({len(stage_profiles)} threads) =====\n")
+            stats.sort_stats('cumulative').print_stats(int(top))
+        if self.skipped:
+            report.write(f"\n{self.skipped} stage calls not profiled, another profiler was active\n")
+        profile_path = join(directory, f"profile_{label}.txt")
+        with open(profile_path, 'w', encoding='utf-8') as file:
+            file.write(report.getvalue())
+
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*")]
+        lines = [f"traced memory now {size / 2**20:.1f} MiB, peak {peak / 2**20:.1f} MiB", "", f"Top {top} allocation sites grown during the run:"]
+        for stat in current.filter_traces(filters).compare_to(snapshot.filter_traces(filters), 'lineno')[:int(top)]:
+            lines.append(str(stat))
+        lines += ["", f"Top {top} allocation sites held at the end (traceback):"]
+        for stat in current.filter_traces(filters).statistics('traceback')[:int(top)]:
+            lines.append(f"{stat.size / 2**10:.1f} KiB in {stat.count} blocks")
+            lines += [f"    {line}" for line in stat.traceback.format()]
+        allocations_path = join(directory, f"allocations_{label}.txt")
+        with open(allocations_path, 'w', encoding='utf-8') as file:
+            file.write("\n".join(lines) + "\n")
+        return [profile_path, allocations_path]
+
+
+
+profiler = Profiler()
@@ -0,0 +1,116 @@
+# Retry + partial failure isolation for api batches.
+# A failing batch is retried with jittered exponential backoff (Retry-After header is honoured),
+# a batch rejected for its content (bad request / mapping error / too large) is split in half until the bad bond IDs
+# are isolated, and those poisoned IDs are collected in a FailureList (persisted next to the dated log) while the rest
+# of the run continues. Auth / not found errors fail the run right away, every other batch would fail the same way.
+
+import csv
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from os import makedirs
+from os.path import dirname
+from threading import Lock
+
+
+# Statuses worth retrying as is: throttled or temporary server side problems
+retryable_statuses = (408, 429, 500, 502, 503, 504)
+# Statuses of a wrong request (credentials, url, method), splitting the batch does not help
+fatal_statuses = (401, 403, 404, 405)
+# Statuses pointing at the batch content (a bad bond ID in it, too many IDs), split to isolate the bad IDs
+split_statuses = (400, 413, 414)
+
+
+# Retry-After is either delay in seconds or a HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+
+class RetryPolicy:
+
+    def __init__(self, max_attempts=4, backoff_base=1, backoff_max=60):
+        self.max_attempts=max(1, int(max_attempts))
+        self.backoff_base=float(backoff_base)
+        self.backoff_max=float(backoff_max)
+
+
+    # Connection errors (no status), timeouts and retryable statuses, mapping errors/bad requests are not retried
+    def is_retryable(self, error):
+        if getattr(error, 'mapping', False) or getattr(error, 'too_large', False):
+            return False
+        return error.timeout or error.status is None or error.status in retryable_statuses
+
+
+    def is_fatal(self, error):
+        return not error.timeout and error.status in fatal_statuses
+
+
+    # Mapping errors + bad request / too large, the other failures are not caused by particular bonds
+    def should_split(self, error):
+        return getattr(error, 'mapping', False) or (not error.timeout and error.status in split_statuses)
+
+
+    # Seconds to wait before next attempt ('attempt' starts at 0), full jitter so parallel batches do not retry in lock step
+    def delay(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max * 5))
+        return delay
+
+
+
+class FailureList:
+
+    def __init__(self, log, max_failed_bonds=1000):
+        self.log=log
+        self.max_failed_bonds=int(max_failed_bonds)
+        self.failures=[]        # (api name, bondId, error)
+        self.lock=Lock()
+
+
+    def add(self, api_name, bondId, error):
+        with self.lock:
+            self.failures.append((api_name, bondId, str(error)))
+            count = len(self.failures)
+        self.log.warning(f"{api_name} api keeps failing for bond {bondId}, skipping it: {str(error)}")
+        # So many bonds failing means the api is down rather than bad bond IDs
+        if count > self.max_failed_bonds:
+            raise SystemExit(f"More than {self.max_failed_bonds} bonds failed, aborting run")
+
+
+    def bonds(self, api_name=None):
+        with self.lock:
+            return {bondId for name, bondId, error in self.failures if api_name is None or name == api_name}
+
+
+    # {bondId: error} of the api's failed bonds
+    def errors(self, api_name):
+        with self.lock:
+            return {bondId: error for name, bondId, error in self.failures if name == api_name}
+
+
+    def __len__(self):
+        return len(self.failures)
+
+
+    # Persist failed bonds as csv, so they can be looked at / re-run later
+    def save(self, path, AsOfDate):
+        if not self.failures:
+            return
+        makedirs(dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(['AsOfDate', 'API', 'BOND', 'Error'])
+            for api_name, bondId, error in self.failures:
+                writer.writerow([AsOfDate, api_name, bondId, error])
+        self.log.warning(f"{len(self.failures)} failed bonds for {AsOfDate} saved to {path}")
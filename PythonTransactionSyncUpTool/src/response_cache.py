@@ -0,0 +1,190 @@
+# Cache of parsed api results per bond (one cache per api), in front of SecurityAPI and CouponAPI.
+# In-process LRU + optional persistent store (SQLite file in [CACHE] dir) so intraday re-runs are served locally.
+# Entries expire after the api's cache_ttl seconds. Expired entries are revalidated with the ETag/Last-Modified
+# the api sent for the same bondId query (If-None-Match/If-Modified-Since), a 304 keeps the cached records.
+
+import json
+import sqlite3
+from collections import OrderedDict
+from os import makedirs
+from os.path import join
+from threading import Lock
+from time import time
+from json_parser import to_json
+
+
+class ResponseCache:
+
+    def __init__(self, name, log, ttl=0, max_entries=100000, cache_dir=None, load_records=None):
+        self.name=name
+        self.log=log
+        self.load_records=load_records or (lambda records: records)     # json of the persistent store -> in memory records
+        self.ttl=float(ttl)                 # seconds, 0 = cache disabled
+        self.max_entries=int(max_entries)
+        self.lock=Lock()
+        self.entries=OrderedDict()          # bond -> (records, stored_at), most recently used last
+        self.validators=OrderedDict()       # bondId query -> (etag, last_modified)
+        self.hits=self.misses=self.revalidated=0
+
+        self.connection=None
+        if self.enabled and cache_dir:
+            makedirs(cache_dir, exist_ok=True)
+            path = join(cache_dir, f"{name}_cache.sqlite")
+            self.connection = sqlite3.connect(path, check_same_thread=False)     # guarded by lock
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (bond TEXT PRIMARY KEY, payload TEXT, stored_at REAL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS validators (query TEXT PRIMARY KEY, etag TEXT, last_modified TEXT)")
+            self.log.debug(f"{name} api cache persisted in {path}")
+
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+
+
+    # Fresh records for the given bonds -> (records, securities not found or expired)
+    def get_many(self, securityList):
+        if not self.enabled:
+            return [], list(securityList)
+        records = []
+        to_fetch = []
+        now = time()
+        with self.lock:
+            for security in securityList:
+                entry = self._get(security)
+                if entry is not None and now - entry[1] < self.ttl:
+                    records += entry[0]
+                    self.hits += 1
+                else:
+                    to_fetch.append(security)
+                    self.misses += 1
+        return records, to_fetch
+
+
+
+    # Bonds of the list with a fresh entry (no hit/miss counting)
+    def fresh(self, securityList):
+        if not self.enabled:
+            return set()
+        now = time()
+        with self.lock:
+            return {security for security in securityList if (entry := self._get(security)) is not None and now - entry[1] < self.ttl}
+
+
+
+    # Conditional request headers, only when every bond of this exact query is cached (but expired)
+    def conditional_headers(self, securityList, securityIDList):
+        if not self.enabled:
+            return {}
+        with self.lock:
+            validator = self._get_validator(securityIDList)
+            if validator is None or any(self._get(security) is None for security in securityList):
+                return {}
+        etag, last_modified = validator
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+
+
+    # Api answered 304 Not Modified -> cached records are still valid, start a new ttl
+    def revalidate(self, securityList):
+        now = time()
+        records = []
+        with self.lock:
+            rows = []
+            for security in securityList:
+                entry = self._get(security)
+                if entry is None:
+                    continue
+                records += entry[0]
+                self._set(security, entry[0], now)
+                rows.append((now, security))
+            self.revalidated += len(rows)
+            if self.connection:
+                with self.connection:
+                    self.connection.executemany("UPDATE entries SET stored_at = ? WHERE bond = ?", rows)
+        return records
+
+
+
+    # Store parsed records of a batch (bonds without records are cached as empty) + validators of the response
+    def put(self, securityList, securityIDList, records, etag=None, last_modified=None):
+        if not self.enabled:
+            return
+        by_bond = {security: [] for security in securityList}
+        for record in records:
+            by_bond.setdefault(record[0], []).append(record)      # records are tuples, bondId first
+        now = time()
+        with self.lock:
+            for bond, bond_records in by_bond.items():
+                if bond is not None:
+                    self._set(bond, bond_records, now)
+            if etag or last_modified:
+                self.validators[securityIDList] = (etag, last_modified)
+                self._evict(self.validators)
+            if self.connection:
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                        [(bond, json.dumps(bond_records, default=to_json), now) for bond, bond_records in by_bond.items() if bond is not None]
+                    )
+                    if etag or last_modified:
+                        self.connection.execute("INSERT OR REPLACE INTO validators VALUES (?, ?, ?)", (securityIDList, etag, last_modified))
+
+
+
+    def summary(self):
+        if not self.enabled:
+            return f"{self.name} api cache disabled"
+        return f"{self.name} api cache: {self.hits} hits, {self.misses} misses, {self.revalidated} revalidated (304), {len(self.entries)} entries in memory"
+
+
+    def close(self):
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+
+
+    # Below helpers expect self.lock to be held
+    def _get(self, bond):
+        entry = self.entries.get(bond)
+        if entry is not None:
+            self.entries.move_to_end(bond)
+            return entry
+        if self.connection:
+            row = self.connection.execute("SELECT payload, stored_at FROM entries WHERE bond = ?", (bond,)).fetchone()
+            if row:
+                entry = (self.load_records(json.loads(row[0])), row[1])
+                self.entries[bond] = entry
+                self._evict(self.entries)
+                return entry
+        return None
+
+
+    def _set(self, bond, records, stored_at):
+        self.entries[bond] = (records, stored_at)
+        self.entries.move_to_end(bond)
+        self._evict(self.entries)
+
+
+    def _get_validator(self, securityIDList):
+        validator = self.validators.get(securityIDList)
+        if validator is None and self.connection:
+            row = self.connection.execute("SELECT etag, last_modified FROM validators WHERE query = ?", (securityIDList,)).fetchone()
+            if row:
+                validator = self.validators[securityIDList] = (row[0], row[1])
+                self._evict(self.validators)
+        return validator
+
+
+    def _evict(self, entries):
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
@@ -0,0 +1,223 @@
+# Service mode (fetch_main.py --serve): the process stays resident, db connection pool, api sessions (keep-alive
+# connections, adaptive batch sizes, response caches) and resolved secrets are kept between jobs.
+# A job is the usual command line (Ex- "2025-08-30 --delta"), jobs come from
+#   - local socket ([SERVICE] port, 127.0.0.1 only), one line per command: run <args> | status | stop
+#   - drop folder ([SERVICE] drop_dir), a file *.job holding the args line, renamed to .queued -> .completed/.failed
+#   - schedule ([SERVICE] schedule=07:00,13:30), runs schedule_args (default today's AsOfDate) at these times
+# Jobs are queued and run 'workers' at a time (1 = one after the other), two jobs of the same AsOfDate never overlap.
+
+import json
+import shlex
+import socketserver
+from glob import glob
+from os import makedirs, replace
+from os.path import splitext
+from collections import deque
+from itertools import count
+from queue import Queue, Empty
+from threading import Lock, Event, Semaphore, Thread
+from time import perf_counter
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RerateService:
+
+    def __init__(self, config, log, db, host='127.0.0.1', port=0, drop_dir='', poll_seconds=5, schedule='', schedule_args='',
+                 workers=1, history=100):
+        from fetch_main import open_apis
+
+        self.config=config
+        self.log=log
+        self.db=db
+        self.host=host
+        self.port=int(port or 0)                    # 0 = no socket
+        self.drop_dir=drop_dir or None
+        self.poll_seconds=float(poll_seconds)
+        self.schedule=sorted(datetime.strptime(time.strip(), "%H:%M").time() for time in str(schedule or '').split(',') if time.strip())
+        self.schedule_args=shlex.split(str(schedule_args or ''))
+        self.workers=max(1, int(workers))
+        self.queue=Queue()
+        self.jobs=deque(maxlen=int(history))        # latest jobs for 'status'
+        self.job_ids=count(1)
+        self.slots=Semaphore(self.workers)
+        self.stopping=Event()
+        self.lock=Lock()
+        self.date_locks={}                          # AsOfDate -> Lock, checkpoint/failure files are per AsOfDate
+        self.server=None
+        self.apis=open_apis(config, log)
+
+
+
+    def serve(self):
+        self.log.info(f"Service started: socket={f'{self.host}:{self.port}' if self.port else 'off'} drop_dir={self.drop_dir or 'off'} "
+                      f"schedule={','.join(time.strftime('%H:%M') for time in self.schedule) or 'off'} workers={self.workers}")
+        threads = []
+        if self.port:
+            self.server = CommandServer((self.host, self.port), CommandHandler)
+            self.server.service = self
+            threads.append(Thread(target=self.server.serve_forever, name='service-socket', daemon=True))
+        if self.drop_dir:
+            makedirs(self.drop_dir, exist_ok=True)
+            threads.append(Thread(target=self._watch_drop_dir, name='service-drop', daemon=True))
+        if self.schedule:
+            threads.append(Thread(target=self._run_schedule, name='service-schedule', daemon=True))
+        for thread in threads:
+            thread.start()
+
+        executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+        try:
+            while not self.stopping.is_set():
+                try:
+                    job = self.queue.get(timeout=1)
+                except Empty:
+                    continue
+                self.slots.acquire()
+                executor.submit(self._run, job)
+        except KeyboardInterrupt:
+            self.log.info("Service interrupted")
+        finally:
+            self.stopping.set()
+            if self.server:
+                self.server.shutdown()
+                self.server.server_close()
+            executor.shutdown(wait=True)        # running jobs complete, queued ones are dropped
+            if self.queue.qsize():
+                self.log.warning(f"Service stopped with {self.queue.qsize()} jobs still queued")
+            for api in self.apis:
+                api.close()
+            self.log.info("Service stopped")
+
+
+
+    # Validates the args like the command line does and queues the job, raises ValueError on bad args
+    def submit(self, argv, source, file=None):
+        from fetch_main import parse_args
+
+        if '--serve' in argv:
+            raise ValueError("--serve can not be queued as a job")
+        try:
+            args, AsOfDate, AsOfDates, shard = parse_args(argv)
+        except SystemExit:
+            raise ValueError(f"Invalid job arguments: {' '.join(argv)}")
+        job = {'id': next(self.job_ids), 'args': argv, 'AsOfDate': AsOfDate, 'source': source, 'status': 'queued',
+               'queued': datetime.now().isoformat(timespec='seconds'), 'file': file}
+        with self.lock:
+            self.jobs.append(job)
+        self.queue.put(job)
+        self.log.info(f"Job {job['id']} queued from {source} for {AsOfDate}: [{' '.join(argv)}]")
+        return job
+
+
+    def status(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'jobs': [dict(job) for job in self.jobs]}
+
+
+    def stop(self):
+        self.log.info("Service stop requested")
+        self.stopping.set()
+
+
+
+    def _run(self, job):
+        from fetch_main import parse_args, run_job, write_metrics
+        from metrics import metrics
+
+        try:
+            args, AsOfDate, AsOfDates, shard = parse_args(job['args'])
+            self.log.roll()     # dated log file follows the day the job runs on, as its failure list + run summary
+            with self._date_lock(AsOfDate):
+                if self.workers == 1:
+                    metrics.reset()     # with concurrent jobs the summary covers the jobs that ran alongside
+                job.update(status='running', started=datetime.now().isoformat(timespec='seconds'))
+                start = perf_counter()
+                status = 'failed'
+                try:
+                    status = run_job(self.config, self.log, self.db, args, AsOfDate, AsOfDates, shard, self.apis)
+                except BaseException as e:      # run_job ends failed runs with SystemExit, the service keeps going
+                    self.log.error(f"Job {job['id']} failed: {repr(e)}")
+                finally:
+                    metrics.observe('total', perf_counter() - start)
+                    write_metrics(self.config, self.log, AsOfDate, shard, status=status, mode='service', job=job['id'])
+                job.update(status=status, finished=datetime.now().isoformat(timespec='seconds'), seconds=round(perf_counter() - start, 3))
+                self.log.info(f"Job {job['id']} {status} in {job['seconds']:.1f}s")
+        finally:
+            if job.get('file'):
+                self._finish_file(job)
+            self.slots.release()
+
+
+    def _date_lock(self, AsOfDate):
+        with self.lock:
+            return self.date_locks.setdefault(AsOfDate, Lock())
+
+
+
+    def _watch_drop_dir(self):
+        while not self.stopping.wait(self.poll_seconds):
+            for path in sorted(glob(f"{self.drop_dir}/*.job")):
+                queued_path = f"{splitext(path)[0]}.queued"
+                try:
+                    replace(path, queued_path)
+                    with open(queued_path, encoding='utf-8') as file:
+                        argv = shlex.split(file.read())
+                    self.submit(argv, f"file {path}", queued_path)
+                except Exception as e:
+                    self.log.error(f"Rejected job file {path}: {e}")
+                    try:
+                        replace(queued_path, f"{splitext(path)[0]}.failed")
+                    except OSError:
+                        pass
+
+
+    def _finish_file(self, job):
+        try:
+            replace(job['file'], f"{splitext(job['file'])[0]}.{'completed' if job['status'] in ('completed', 'no securities') else 'failed'}")
+        except OSError as e:
+            self.log.warning(f"Failed to rename job file {job['file']}: {e}")
+
+
+
+    def _run_schedule(self):
+        while not self.stopping.is_set():
+            now = datetime.now()
+            runs = [datetime.combine(now.date() + timedelta(days=day), time) for day in (0, 1) for time in self.schedule]
+            next_run = min(run for run in runs if run > now)
+            self.log.info(f"Next scheduled job at {next_run}")
+            if self.stopping.wait((next_run - now).total_seconds()):
+                break
+            try:
+                self.submit(list(self.schedule_args), 'schedule')
+            except ValueError as e:
+                self.log.error(f"Scheduled job not queued: {e}")
+
+
+
+class CommandServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+
+# One json response line per command line: run <args> | status | stop
+class CommandHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        service = self.server.service
+        for line in self.rfile:
+            command, _, rest = line.decode('utf-8', 'replace').strip().partition(' ')
+            try:
+                if command == 'run':
+                    job = service.submit(shlex.split(rest), f"socket {self.client_address[0]}")
+                    response = {'ok': True, 'job': job['id'], 'AsOfDate': job['AsOfDate']}
+                elif command == 'status':
+                    response = dict(service.status(), ok=True)
+                elif command == 'stop':
+                    service.stop()
+                    response = {'ok': True}
+                else:
+                    response = {'ok': False, 'error': f"Unknown command '{command}', expected run <args> | status | stop"}
+            except ValueError as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(response, default=str) + "\n").encode('utf-8'))
@@ -0,0 +1,35 @@
+# Hash partitioning of bonds into shards, so a run can be split over worker processes (--processes N)
+# or over separate invocations / hosts (--shard i/N) with every bond owned by exactly one shard.
+# crc32 is used instead of hash(): python's str hash is salted per process, crc32 is the same on every host.
+
+from zlib import crc32
+from bond_ids import normalize_id
+
+
+# "2/4" -> (2, 4), shards are numbered 1..N
+def parse_shard(text):
+    try:
+        index, count = (int(part) for part in str(text).split('/'))
+    except ValueError:
+        raise ValueError(f"Invalid shard '{text}', expected i/N (Ex- 1/4)")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{text}', i must be between 1 and N")
+    return index, count
+
+
+# Normalized ID is hashed, so ' XS1 ' and 'XS1' (same bond) always land in the same shard
+def shard_of(security, count):
+    return crc32((normalize_id(security) or '').encode('utf-8')) % count + 1
+
+
+# Securities of the shard (generator, keeps the input streaming)
+def in_shard(securityIDList, shard):
+    index, count = shard
+    for security in securityIDList:
+        if shard_of(security, count) == index:
+            yield security
+
+
+# File name suffix of per shard files (checkpoint, failure list), empty for an unsharded run
+def shard_suffix(shard):
+    return f"_shard{shard[0]}of{shard[1]}" if shard else ""
@@ -2,17 +2,34 @@
 # This file is use to fetch API details like (token, user key, passwords) and connection string from another static application
 # For example - SMSPasswordRetrieval
 # Created and stored at another location whose path is present in config.ini
+# All keys of the config are resolved in parallel (one exe process per key), resolved values are kept in a short ttl
+# local cache encrypted for the current windows user (DPAPI), so back to back runs do not start the exe at all.
+# Cache is disabled where DPAPI is not available, secrets are never written in plain text.
 
 
+import json
+import sys
 import subprocess
+from time import time
+from os import makedirs, replace
+from os.path import dirname
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger, CRITICAL
 
 class SMS():
 
-    def __init__(self, exe_path, log):
+    def __init__(self, exe_path, log, timeout=60, max_workers=8, cache_path=None, cache_ttl=0):
         self.exe_path=exe_path
         self.log=log
         self.secrets={}
+        self.resolved_at={}                     # key -> time resolved by the exe (cached values keep their original time)
+        self.timeout=float(timeout)             # seconds per exe call
+        self.max_workers=int(max_workers)       # exe processes run at once
+        self.cache_ttl=float(cache_ttl)         # seconds resolved values are reused from cache file, 0 = no cache
+        self.cache_path=cache_path if cache_path and self.cache_ttl > 0 and dpapi_available() else None
+        if cache_path and self.cache_ttl > 0 and self.cache_path is None:
+            self.log.info("SMS cache disabled, DPAPI encryption is only available on windows")
+        self.secrets.update(self._load_cache())
 
 
     def get(self, key):
@@ -22,21 +39,100 @@ class SMS():
             pass
             try:
                 self.secrets[key] = self.get_sms_value(key)
+                self._save_cache()
             except Exception as e:
                 self.log.exception(e)
         return self.secrets.get(key)
-    
+
+
+    # Resolves all keys not known yet in parallel, returns {key: value}. Keys that failed are kept as None,
+    # so they are not looked up again one by one (get) later in the same run.
+    def get_many(self, keys):
+        missing = list(dict.fromkeys(key for key in keys if key not in self.secrets))
+        if missing:
+            self.log.debug(f"Resolving {len(missing)} SMS keys")
+            with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(missing))), thread_name_prefix='sms') as executor:
+                futures = {key: executor.submit(self.get_sms_value, key) for key in missing}
+            for key, future in futures.items():
+                try:
+                    self.secrets[key] = future.result()
+                except Exception as e:
+                    self.secrets[key] = None
+                    self.log.exception(e)
+            self._save_cache()
+        return {key: self.secrets.get(key) for key in keys}
+
 
     def get_sms_value(self, key):
         command = [self.exe_path, key]
         self.log.debug(f"command: {command}")
         self.log.debug(f"executable path: {self.exe_path}")
         try:
-            result=subprocess.run(command, capture_output=True, text=True, timeout=3000)
+            result=subprocess.run(command, capture_output=True, text=True, timeout=self.timeout)
             self.log.debug(f"STOUT: {result.stderr}")
             if result.returncode != 0 or not any(result.stdout) or any(result.stderr):
                 raise Exception(f"Error retrieving SMS key '{key}'\n{result}")
             return result.stdout.strip()
         except subprocess.TimeoutExpired:
             self.log.error(f"Timout while retrieving SMS {key}")
-            return None
\ No newline at end of file
+            return None
+
+
+
+    # Cache file: DPAPI encrypted json {key: [value, resolved_at]}
+    def _load_cache(self):
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path, 'rb') as file:
+                entries = json.loads(dpapi(file.read(), protect=False))
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.log.warning(f"Ignoring unreadable SMS cache {self.cache_path}: {e}")
+            return {}
+        now = time()
+        secrets = {key: value for key, (value, resolved_at) in entries.items() if now - resolved_at < self.cache_ttl}
+        self.resolved_at = {key: entries[key][1] for key in secrets}
+        self.log.debug(f"{len(secrets)} SMS keys taken from cache")
+        return secrets
+
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        now = time()
+        entries = {key: [value, self.resolved_at.get(key, now)] for key, value in self.secrets.items() if value is not None}
+        self.resolved_at = {key: entry[1] for key, entry in entries.items()}
+        try:
+            makedirs(dirname(self.cache_path) or '.', exist_ok=True)
+            with open(f"{self.cache_path}.tmp", 'wb') as file:
+                file.write(dpapi(json.dumps(entries).encode('utf-8'), protect=True))
+            replace(f"{self.cache_path}.tmp", self.cache_path)
+        except Exception as e:
+            self.log.warning(f"Failed to write SMS cache {self.cache_path}: {e}")
+
+
+
+def dpapi_available():
+    return sys.platform == 'win32'
+
+
+# Encrypts/decrypts bytes with windows DPAPI (CryptProtectData), only the same windows user can decrypt
+def dpapi(data, protect):
+    import ctypes
+    from ctypes import wintypes
+
+    class DataBlob(ctypes.Structure):
+        _fields_ = [('cbData', wintypes.DWORD), ('pbData', ctypes.POINTER(ctypes.c_char))]
+
+    buffer = ctypes.create_string_buffer(data, len(data))
+    blob_in = DataBlob(len(data), ctypes.cast(buffer, ctypes.POINTER(ctypes.c_char)))
+    blob_out = DataBlob()
+    function = ctypes.windll.crypt32.CryptProtectData if protect else ctypes.windll.crypt32.CryptUnprotectData
+    if not function(ctypes.byref(blob_in), None, None, None, None, 0x01, ctypes.byref(blob_out)):     # 0x01 = CRYPTPROTECT_UI_FORBIDDEN
+        raise ctypes.WinError()
+    try:
+        return ctypes.string_at(blob_out.pbData, blob_out.cbData)
+    finally:
+        ctypes.windll.kernel32.LocalFree(blob_out.pbData)
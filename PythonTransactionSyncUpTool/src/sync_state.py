@@ -0,0 +1,72 @@
+# Remembers per bond + AsOfDate the last APIRate/CpnEffectiveDate written into tbl_RerateRecon (SQLite file in [CACHE] dir).
+# Used by --delta mode: bonds already written for the AsOfDate whose cached api data is still fresh are not fetched
+# again, and rows whose values did not change are not UPDATEd again.
+
+import sqlite3
+from datetime import datetime
+from os import makedirs
+from os.path import dirname
+from threading import Lock
+
+
+# Values compared as written into db (APIRate is decimal(9,2) there), so a change below 2 decimals is no change
+def row_key(rate, EffectiveDate):
+    return (round(float(rate), 2), str(EffectiveDate))
+
+
+
+class SyncState:
+
+    def __init__(self, path, log):
+        self.log=log
+        self.path=path
+        self.lock=Lock()
+
+        makedirs(dirname(path) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)     # guarded by lock
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS written (
+                bond TEXT NOT NULL,
+                as_of_date TEXT NOT NULL,
+                rate REAL,
+                effective_date TEXT,
+                written_at TEXT,
+                PRIMARY KEY (bond, as_of_date)
+            )
+        """)
+        self.log.debug(f"Sync state in {path}")
+
+
+
+    # Last written values of the given bonds for the AsOfDate -> {bond: (rate, EffectiveDate)}
+    def written(self, AsOfDate, securityList):
+        written = {}
+        with self.lock:
+            for i in range(0, len(securityList), 500):     # stay below sqlite host parameter limit
+                part = securityList[i:i + 500]
+                rows = self.connection.execute(
+                    f"SELECT bond, rate, effective_date FROM written WHERE as_of_date = ? AND bond IN ({','.join('?' * len(part))})",
+                    (AsOfDate, *part)
+                ).fetchall()
+                for bond, rate, effective_date in rows:
+                    written[bond] = row_key(rate, effective_date)
+        return written
+
+
+
+    # rows: [(bond, AsOfDate, rate, EffectiveDate)] written into db
+    def record(self, rows):
+        written_at = datetime.now().isoformat(timespec='seconds')
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO written VALUES (?, ?, ?, ?, ?)",
+                [(bond, AsOfDate, float(rate), str(EffectiveDate), written_at) for bond, AsOfDate, rate, EffectiveDate in rows]
+            )
+
+
+
+    def close(self):
+        with self.lock:
+            self.connection.close()